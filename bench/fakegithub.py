@@ -0,0 +1,346 @@
+'''fakegithub.py
+
+A local stand-in for the parts of the GitHub REST API grv uses.
+
+run with python -m bench.fakegithub --help
+'''
+import argparse
+import BaseHTTPServer
+import collections
+import datetime
+import hashlib
+import json
+import random
+import re
+import SocketServer
+import threading
+import time
+import urlparse
+
+
+def iso(t):
+    return datetime.datetime.utcfromtimestamp(t).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def make_pulls(merges, extra_pulls=0, comments_per_pull=3, review_ratio=0.7,
+               users=20, seed=0):
+    """Builds pulls and their comments for the merges of a synthetic repo.
+
+    Each merge gets a merged pull whose head is the merge's second parent.
+    extra_pulls closed, unmerged pulls are added on top. A review_ratio
+    share of the merged pulls has an approving comment from someone other
+    than the requester.
+
+    Returns:
+        (pulls, comments), pulls as a list of dicts oldest first and
+        comments as a dict of pull number to list of dicts.
+    """
+    rnd = random.Random(seed)
+    items = [(m["time"], m["head_sha"]) for m in merges]
+    last = items[-1][0] if items else 1400000000
+    for i in range(extra_pulls):
+        items.append((last + i, None))
+    items.sort()
+
+    pulls = []
+    comments = {}
+    for number, (t, head_sha) in enumerate(items, 1):
+        requester = rnd.randrange(users)
+        pulls.append({
+            "number": number,
+            "title": "Pull %s" % number,
+            "user": "u%d" % requester,
+            "base_sha": "0" * 40,
+            "head_sha": head_sha or hashlib.sha1(str(number)).hexdigest(),
+            "created_at": t - 3600,
+            "updated_at": t,
+            "merged_at": t if head_sha else None,
+            })
+        reviewed = head_sha and rnd.random() < review_ratio
+        pull_comments = []
+        for i in range(comments_per_pull):
+            login = "u%d" % rnd.randrange(users)
+            body = "Please fix the tests."
+            if reviewed and i == comments_per_pull - 1:
+                login = "u%d" % ((requester + 1) % users)
+                body = "LGTM"
+            pull_comments.append({
+                "id": number * 1000 + i,
+                "user": login,
+                "body": body,
+                "created_at": t - 3600 + i,
+                "updated_at": t - 3600 + i,
+                })
+        comments[number] = pull_comments
+    return pulls, comments
+
+
+class FakeGithub(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves pulls and comments of one repo, counting the requests.
+
+    Responses carry an ETag and conditional requests get a 304, which is
+    counted apart as it does not use rate limit. latency seconds are slept
+    before each answer. Issue search understands merged: ranges and
+    quoted phrases, and like GitHub gives no results past search_cap.
+
+    With rate_limit set, each token gets that many requests per resource
+    every rate_window seconds, and is refused with a 403 past it.
+    Requests are also counted per token in by_token.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, owner, repo, pulls, comments, port=0, latency=0.0, search_cap=1000,
+                 rate_limit=None, rate_window=60):
+        BaseHTTPServer.HTTPServer.__init__(self, ("localhost", port), _Handler)
+        self.owner = owner
+        self.repo = repo
+        self.pulls = pulls
+        self.comments = comments
+        self.by_number = dict((p["number"], p) for p in pulls)
+        self.latency = latency
+        self.search_cap = search_cap
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.by_token = collections.Counter()
+        # (token, resource) -> [used, reset]
+        self.used = {}
+        self.url = "http://localhost:%d" % self.server_address[1]
+
+    def count(self, kind):
+        with self.lock:
+            self.counts[kind] += 1
+
+    def use(self, token, resource):
+        """Counts a request of token. Returns (remaining, reset), remaining
+        being -1 if it is refused."""
+        with self.lock:
+            self.by_token[token] += 1
+            limit = self.rate_limit or 5000
+            now = int(time.time())
+            used = self.used.get((token, resource))
+            if not used or used[1] <= now:
+                used = self.used[(token, resource)] = [0, now + self.rate_window]
+            if self.rate_limit and used[0] >= limit:
+                return -1, used[1]
+            used[0] += 1
+            return limit - used[0], used[1]
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts)
+
+    def start(self):
+        """Serves from a daemon thread."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def user_json(self, login):
+        return {"login": login, "id": hash(login) & 0xffff, "type": "User",
+                "url": "%s/users/%s" % (self.url, login)}
+
+    def repo_json(self):
+        return {"name": self.repo, "full_name": "%s/%s" % (self.owner, self.repo),
+                "owner": self.user_json(self.owner),
+                "url": "%s/repos/%s/%s" % (self.url, self.owner, self.repo)}
+
+    def pull_json(self, pull):
+        base = "%s/repos/%s/%s" % (self.url, self.owner, self.repo)
+        return {
+            "number": pull["number"],
+            "url": "%s/pulls/%d" % (base, pull["number"]),
+            "issue_url": "%s/issues/%d" % (base, pull["number"]),
+            "title": pull["title"],
+            "user": self.user_json(pull["user"]),
+            "state": "closed",
+            "base": {"sha": pull["base_sha"], "ref": "master"},
+            "head": {"sha": pull["head_sha"], "ref": "topic-%d" % pull["number"]},
+            "created_at": iso(pull["created_at"]),
+            "updated_at": iso(pull["updated_at"]),
+            "merged_at": iso(pull["merged_at"]) if pull["merged_at"] else None,
+            }
+
+    def issue_json(self, pull):
+        base = "%s/repos/%s/%s" % (self.url, self.owner, self.repo)
+        return {
+            "number": pull["number"],
+            "url": "%s/issues/%d" % (base, pull["number"]),
+            "comments_url": "%s/issues/%d/comments" % (base, pull["number"]),
+            "title": pull["title"],
+            "user": self.user_json(pull["user"]),
+            "state": "closed",
+            "comments": len(self.comments.get(pull["number"], ())),
+            "pull_request": {"url": "%s/pulls/%d" % (base, pull["number"])},
+            "created_at": iso(pull["created_at"]),
+            "updated_at": iso(pull["updated_at"]),
+            }
+
+    def comment_json(self, number, comment):
+        return {
+            "id": comment["id"],
+            "url": "%s/repos/%s/%s/issues/comments/%d" % (
+                self.url, self.owner, self.repo, comment["id"]),
+            "issue_url": "%s/repos/%s/%s/issues/%d" % (
+                self.url, self.owner, self.repo, number),
+            "user": self.user_json(comment["user"]),
+            "body": comment["body"],
+            "created_at": iso(comment["created_at"]),
+            "updated_at": iso(comment["updated_at"]),
+            }
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        parts = url.path.strip("/").split("/")
+        repo_path = ["repos", server.owner, server.repo]
+        time.sleep(server.latency)
+
+        token = self.headers.get("Authorization", "").replace("token ", "")
+        resource = "search" if parts[0] == "search" else "core"
+        remaining, reset = server.use(token, resource)
+        self.rate_headers = [("X-RateLimit-Limit", str(server.rate_limit or 5000)),
+                             ("X-RateLimit-Remaining", str(max(remaining, 0))),
+                             ("X-RateLimit-Reset", str(reset)),
+                             ("X-RateLimit-Resource", resource)]
+        if remaining < 0:
+            return self.send_status("rate_limited", 403, "API rate limit exceeded")
+
+        if parts[0] == "users" and len(parts) == 2:
+            return self.send("users", server.user_json(parts[1]))
+        if parts == repo_path:
+            return self.send("repos", server.repo_json())
+        if parts == repo_path + ["pulls"]:
+            pulls = list(server.pulls)
+            state = query.get("state", "open")
+            if state == "open":
+                pulls = []
+            key = "created_at" if query.get("sort") == "created" else "updated_at"
+            pulls.sort(key=lambda p: (p[key], p["number"]),
+                       reverse=query.get("direction", "desc") == "desc")
+            return self.send_page("pulls", pulls, query, server.pull_json)
+        if parts[:4] == repo_path + ["issues"] and len(parts) >= 5:
+            pull = server.by_number.get(int(parts[4]))
+            if pull is None:
+                return self.send_status("issues", 404)
+            if len(parts) == 5:
+                return self.send("issues", server.issue_json(pull))
+            if parts[5:] == ["comments"]:
+                comments = server.comments.get(pull["number"], [])
+                if "since" in query:
+                    comments = [c for c in comments if iso(c["updated_at"]) >= query["since"]]
+                return self.send_page("comments", [server.comment_json(pull["number"], c)
+                                                   for c in comments], query)
+        if parts == ["search", "issues"]:
+            return self.send_search(query)
+        if parts == ["rate_limit"]:
+            core = {"limit": 5000, "remaining": 5000, "reset": int(time.time()) + 3600}
+            return self.send("rate_limit", {"resources": {"core": core, "search": core},
+                                            "rate": core})
+        return self.send_status("other", 404)
+
+    def send_search(self, query):
+        """Finds the merged pulls with a comment holding a quoted phrase of q."""
+        server = self.server
+        q = query.get("q", "")
+        merged = re.search(r"merged:(\S+)\.\.(\S+)", q)
+        phrases = [p.lower() for p in re.findall(r'"([^"]+)"', q)]
+        found = []
+        for pull in server.pulls:
+            if not pull["merged_at"]:
+                continue
+            if merged and not merged.group(1) <= iso(pull["merged_at"]) <= merged.group(2):
+                continue
+            bodies = [c["body"].lower() for c in server.comments.get(pull["number"], [])]
+            if any(p in body for p in phrases for body in bodies):
+                found.append(pull)
+
+        page = int(query.get("page", 1))
+        per_page = int(query.get("per_page", 30))
+        if (page - 1) * per_page >= server.search_cap:
+            return self.send_status("search", 422)
+        items = [server.issue_json(p) for p in
+                 found[:server.search_cap][(page - 1) * per_page:page * per_page]]
+        self.send("search", {"total_count": len(found), "incomplete_results": False,
+                             "items": items})
+
+    def send_page(self, kind, items, query, to_json=None):
+        """Sends a page of items, each passed through to_json if given."""
+        page = int(query.get("page", 1))
+        per_page = int(query.get("per_page", 30))
+        headers = []
+        if page * per_page < len(items):
+            query = dict(query, page=page + 1)
+            link = "%s%s?%s" % (self.server.url, urlparse.urlparse(self.path).path,
+                                "&".join("%s=%s" % kv for kv in sorted(query.items())))
+            headers.append(("Link", '<%s>; rel="next"' % link))
+        items = items[(page - 1) * per_page:page * per_page]
+        if to_json:
+            items = [to_json(item) for item in items]
+        self.send(kind, items, headers)
+
+    def send(self, kind, body, headers=()):
+        data = json.dumps(body)
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            self.server.count("not_modified")
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            for name, value in self.rate_headers:
+                self.send_header(name, value)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.server.count(kind)
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in self.rate_headers:
+            self.send_header(name, value)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_status(self, kind, status, message="Not Found"):
+        self.server.count(kind)
+        data = json.dumps({"message": message})
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        for name, value in self.rate_headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve fake GitHub pulls.')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--pulls', type=int, default=100)
+    parser.add_argument('--comments', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.0)
+    args = parser.parse_args()
+
+    merges = [{"time": 1400000000 + i * 600, "head_sha": hashlib.sha1("h%d" % i).hexdigest()}
+              for i in range(args.pulls)]
+    pulls, comments = make_pulls(merges, comments_per_pull=args.comments)
+    server = FakeGithub("owner", "repo", pulls, comments, args.port, args.latency)
+    print "Serving %s pulls on %s" % (len(pulls), server.url)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
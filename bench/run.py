@@ -0,0 +1,222 @@
+'''run.py
+
+Times grv.py commands against a synthetic repo and a fake GitHub server.
+
+run with python -m bench.run --help
+'''
+import argparse
+import distutils.spawn
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import bench.fakegithub
+import bench.synthrepo
+
+
+GRV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "grv.py")
+
+# Each step is a name and the grv.py command it runs. Running a command
+# twice times the cold and the warm (incremental) case.
+STEPS = [
+    ("init-pulls", "init-pulls"),
+    ("update-pulls", "update-pulls"),
+    ("update-repo", "update-repo"),
+    ("update-repo-warm", "update-repo"),
+    ("report-all", "report-all"),
+    ("list-violations", "list-violations"),
+    ]
+
+LABEL = "bench-master"
+
+
+def git_wrapper(bin_dir, count_file):
+    """Puts a git on PATH which logs a line per process to count_file."""
+    real_git = distutils.spawn.find_executable("git")
+    os.makedirs(bin_dir)
+    path = os.path.join(bin_dir, "git")
+    with open(path, "w") as f:
+        f.write('#!/bin/sh\necho "$1" >> "%s"\nexec "%s" "$@"\n' % (count_file, real_git))
+    os.chmod(path, 0755)
+    return bin_dir
+
+
+def count_lines(path):
+    if not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        return sum(1 for _ in f)
+
+
+def run_step(name, cmd, workdir, env, server, extra_args):
+    """Runs one grv.py command and returns its measures."""
+    count_file = env["GRV_BENCH_GIT_LOG"]
+    git_before = count_lines(count_file)
+    api_before = server.stats()
+    metrics_file = os.path.join(workdir, "metrics-%s.json" % name)
+    argv = [sys.executable, GRV, "--cf", os.path.join(workdir, "config.json"),
+            "--label", LABEL, "--metrics-json", metrics_file, cmd] + extra_args
+
+    start = time.time()
+    proc = subprocess.Popen(argv, cwd=workdir, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    seconds = time.time() - start
+
+    api_after = server.stats()
+    api = dict((k, v - api_before.get(k, 0)) for k, v in api_after.items()
+               if v != api_before.get(k, 0))
+    if proc.returncode:
+        logging.error("%s failed:\n%s", name, err)
+    metrics = None
+    if os.path.exists(metrics_file):
+        with open(metrics_file) as f:
+            metrics = json.load(f)
+    return {
+        "name": name,
+        "cmd": cmd,
+        "seconds": round(seconds, 3),
+        "returncode": proc.returncode,
+        "git_processes": count_lines(count_file) - git_before,
+        "api_requests": sum(v for k, v in api.items() if k != "not_modified"),
+        "api_not_modified": api.get("not_modified", 0),
+        "api_by_kind": api,
+        "output_lines": len(out.splitlines()),
+        "metrics": metrics,
+        }
+
+
+def run(args, workdir):
+    logging.info("Generating a repo of %s commits in %s", args.commits, workdir)
+    start = time.time()
+    repo = bench.synthrepo.generate(workdir, args.commits, args.merge_ratio,
+                                    args.files_per_commit, args.branch_depth,
+                                    seed=args.seed)
+    pulls, comments = bench.fakegithub.make_pulls(
+        repo["merges"], args.extra_pulls, args.comments_per_pull, seed=args.seed)
+    generate_seconds = time.time() - start
+
+    server = bench.fakegithub.FakeGithub("owner", "repo", pulls, comments,
+                                         latency=args.latency)
+    server.start()
+
+    config = {
+        "credentials": {"github_personal_access_token": "bench"},
+        "paths": {"database": os.path.join(workdir, "dbgrv.db")},
+        "github": {"api_url": server.url},
+        "repos": [{
+            "label": LABEL,
+            "github_owner": "owner",
+            "github_repo": "repo",
+            "git_repo_dir": repo["work"],
+            "branch": "master",
+            }],
+        }
+    with open(os.path.join(workdir, "config.json"), "w") as f:
+        json.dump(config, f, indent=4)
+
+    env = dict(os.environ)
+    env["GRV_BENCH_GIT_LOG"] = os.path.join(workdir, "git.log")
+    env["PATH"] = git_wrapper(os.path.join(workdir, "bin"), env["GRV_BENCH_GIT_LOG"]) + \
+        os.pathsep + env.get("PATH", "")
+
+    steps = STEPS
+    if args.steps:
+        names = args.steps.split(",")
+        steps = [s for s in STEPS if s[0] in names]
+    extra_args = {
+        "report-all": ["--stats"] if args.stats else [],
+        "list-violations": ["--stats"] if args.stats else [],
+        "init-pulls": ["--use-search"] if args.use_search else [],
+        "update-pulls": ["--use-search"] if args.use_search else [],
+        }
+
+    results = []
+    for name, cmd in steps:
+        logging.info("Running %s", name)
+        results.append(run_step(name, cmd, workdir, env, server,
+                                extra_args.get(cmd, [])))
+    server.shutdown()
+
+    return {
+        "params": {
+            "commits": args.commits,
+            "merge_ratio": args.merge_ratio,
+            "files_per_commit": args.files_per_commit,
+            "branch_depth": args.branch_depth,
+            "pulls": len(pulls),
+            "merges": len(repo["merges"]),
+            "comments_per_pull": args.comments_per_pull,
+            "latency": args.latency,
+            "stats": args.stats,
+            "use_search": args.use_search,
+            "seed": args.seed,
+            },
+        "env": {
+            "python": platform.python_version(),
+            "git": subprocess.check_output(["git", "--version"]).strip(),
+            "platform": platform.platform(),
+            },
+        "time": int(time.time()),
+        "generate_seconds": round(generate_seconds, 3),
+        "steps": results,
+        "total_seconds": round(sum(s["seconds"] for s in results), 3),
+        "ok": all(s["returncode"] == 0 for s in results),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark grv.py.')
+    parser.add_argument('--commits', type=int, default=5000,
+                        help='First-parent commits in the synthetic repo.')
+    parser.add_argument('--merge-ratio', type=float, default=0.3,
+                        help='Share of first-parent commits that are merged pulls.')
+    parser.add_argument('--files-per-commit', type=int, default=3)
+    parser.add_argument('--branch-depth', type=int, default=2,
+                        help='Commits on each merged topic branch.')
+    parser.add_argument('--extra-pulls', type=int, default=0,
+                        help='Closed pulls that were never merged.')
+    parser.add_argument('--comments-per-pull', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds the fake GitHub waits before each answer.')
+    parser.add_argument('--stats', action="store_true",
+                        help='Run the reports with --stats.')
+    parser.add_argument('--use-search', action="store_true",
+                        help='Pass --use-search to init-pulls and update-pulls.')
+    parser.add_argument('--steps', help='Comma separated steps to run, of %s.'
+                        % ", ".join(s[0] for s in STEPS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help='Write the JSON results here instead of stdout.')
+    parser.add_argument('--keep', action="store_true",
+                        help='Keep the generated repos and database.')
+    parser.add_argument('--verbose', action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    workdir = tempfile.mkdtemp(prefix="grvbench-")
+    try:
+        results = run(args, workdir)
+    finally:
+        if args.keep:
+            logging.warning("Kept %s", workdir)
+        else:
+            shutil.rmtree(workdir)
+
+    pretty = json.dumps(results, sort_keys=True, indent=4, separators=(',', ': '))
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(pretty + "\n")
+    else:
+        print pretty
+    if not results["ok"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
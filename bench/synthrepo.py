@@ -0,0 +1,113 @@
+'''synthrepo.py
+
+Generates synthetic git repositories for benchmarks.
+
+run with python -m bench.synthrepo --help
+'''
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+
+
+def generate(path, commits=1000, merge_ratio=0.3, files_per_commit=3,
+             branch_depth=2, authors=20, seed=0, start_time=1400000000):
+    """Creates a bare origin repo and a clone of it under path.
+
+    The first-parent history of master has `commits` commits. A
+    `merge_ratio` share of them are merges of a topic branch of
+    `branch_depth` commits, like merged pull requests. Each commit
+    touches `files_per_commit` files. History is written with one
+    `git fast-import`, so generation is fast even for long histories.
+
+    Returns:
+        A dict with the paths of the repos and, for every merge, its
+        sha, its second parent (the pull head) and its time.
+    """
+    rnd = random.Random(seed)
+    origin = os.path.join(path, "origin.git")
+    work = os.path.join(path, "work")
+    subprocess.check_call(['git', 'init', '--quiet', '--bare', origin])
+    marks_file = os.path.join(path, "marks")
+
+    proc = subprocess.Popen(['git', 'fast-import', '--quiet',
+                             '--export-marks=%s' % marks_file],
+                            cwd=origin, stdin=subprocess.PIPE)
+    out = proc.stdin
+    state = {"mark": 0, "time": start_time}
+
+    def commit(ref, parent, merge=None):
+        state["mark"] += 1
+        state["time"] += rnd.randint(60, 3600)
+        author = rnd.randrange(authors)
+        message = "Change %s\n" % state["mark"]
+        out.write("commit %s\n" % ref)
+        out.write("mark :%d\n" % state["mark"])
+        out.write("committer Dev %d <dev%d@example.com> %d +0000\n"
+                  % (author, author, state["time"]))
+        out.write("data %d\n%s" % (len(message), message))
+        if parent:
+            out.write("from :%d\n" % parent)
+        if merge:
+            out.write("merge :%d\n" % merge)
+        else:
+            for _ in range(files_per_commit):
+                content = "%s\n" % rnd.random()
+                out.write("M 100644 inline src/f%d.txt\n" % rnd.randrange(commits * 2))
+                out.write("data %d\n%s" % (len(content), content))
+        out.write("\n")
+        return state["mark"], state["time"]
+
+    merges = []
+    tip = None
+    for _ in range(commits):
+        if tip and rnd.random() < merge_ratio:
+            topic = tip
+            for _ in range(branch_depth):
+                topic, _ = commit("refs/heads/topic", topic)
+            tip, merge_time = commit("refs/heads/master", tip, merge=topic)
+            merges.append((tip, topic, merge_time))
+        else:
+            tip, _ = commit("refs/heads/master", tip)
+    out.write("reset refs/heads/topic\nfrom 0000000000000000000000000000000000000000\n\n")
+    out.close()
+    if proc.wait():
+        raise subprocess.CalledProcessError(proc.returncode, 'git fast-import')
+
+    marks = {}
+    with open(marks_file) as mf:
+        for line in mf:
+            mark, sha = line.split()
+            marks[int(mark[1:])] = sha
+
+    subprocess.check_call(['git', 'clone', '--quiet', origin, work])
+    return {
+        "origin": origin,
+        "work": work,
+        "commits": commits,
+        "merges": [{"sha": marks[m], "head_sha": marks[h], "time": t}
+                   for m, h, t in merges],
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic git repo.')
+    parser.add_argument('path', help='Directory to create the repos in.')
+    parser.add_argument('--commits', type=int, default=1000)
+    parser.add_argument('--merge-ratio', type=float, default=0.3)
+    parser.add_argument('--files-per-commit', type=int, default=3)
+    parser.add_argument('--branch-depth', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    os.makedirs(args.path)
+    repo = generate(args.path, args.commits, args.merge_ratio, args.files_per_commit,
+                    args.branch_depth, seed=args.seed)
+    print json.dumps(dict(repo, merges=len(repo["merges"])), indent=4)
+
+
+if __name__ == "__main__":
+    main()
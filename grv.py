@@ -1,13 +1,21 @@
 #!/usr/bin/env python
+import cProfile
 import datetime
 import argparse
+import fnmatch
 import logging
 import json
+import multiprocessing
+import os
+import StringIO
 import sys
+import time
 
 import lib.operations
+import lib.grvserve
 import lib.grvgit
 import lib.grvdb
+from lib.grvmetrics import metrics
 
 
 blank_config = """{
@@ -35,6 +43,34 @@ def parse_config(cf):
     return config
 
 
+def github_tokens(config):
+    """Returns the tokens of config, github_personal_access_token first."""
+    credentials = config["credentials"]
+    tokens = []
+    for token in ([credentials.get("github_personal_access_token")] +
+                  credentials.get("github_personal_access_tokens", [])):
+        if token and token not in tokens:
+            tokens.append(token)
+    return tokens
+
+
+def github_options(config):
+    """Maps the optional "github" section of config to GRVGithub arguments."""
+    options = config.get("github", {})
+    kwargs = {"tokens": github_tokens(config)}
+    if "api_url" in options:
+        kwargs["base_url"] = options["api_url"]
+    if "comment_workers" in options:
+        kwargs["comment_workers"] = int(options["comment_workers"])
+    if "page_workers" in options:
+        kwargs["page_workers"] = int(options["page_workers"])
+    kwargs["http_cache"] = options.get("http_cache", os.path.join(
+        os.path.dirname(config["paths"]["database"]), "grvhttp.db"))
+    if "http_cache_mb" in options:
+        kwargs["http_cache_mb"] = int(options["http_cache_mb"])
+    return kwargs
+
+
 def process_args(argv):
     parser = argparse.ArgumentParser(description='Audit git repository.')
     parser.add_argument('--cf', default="config.json",
@@ -43,19 +79,49 @@ def process_args(argv):
                         choices=('report-all', 'update-pulls', 'update-repo',
                                  'list-merge-commits', 'blank-config', 'list-direct-commits',
                                  'list-pulls', 'list-all-commits', 'init-pulls', 'list-repos',
-                                 'list-violations'))
-    parser.add_argument('--label', help='Which repo/branch should I work on?')
+                                 'list-violations', 'recompute-reviewers', 'serve', 'query'))
+    parser.add_argument('--label', help='Which repo/branch should I work on? '
+                        'A glob like "web-*" picks several.')
+    parser.add_argument('--all', action="store_true",
+                        help='Work on every repo in config.')
+    parser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(),
+                        help='How many repos to work on at once.')
+    parser.add_argument('--scan-jobs', type=int, default=1,
+                        help='update-repo: read a long history in this many processes.')
     parser.add_argument('--verbose', action="store_true")
     parser.add_argument('--since', help='return results from now until `since` hours ago.')
+    parser.add_argument('--until', help='query: return results from before `until` hours ago.')
+    parser.add_argument('--author', help='query: only commits by this email.')
+    parser.add_argument('--type', choices=lib.grvdb.Reports.TYPES,
+                        help='query: only direct, merge or pull commits.')
+    parser.add_argument('--reviewed', choices=('yes', 'no'),
+                        help='query: only reviewed or unreviewed commits.')
+    parser.add_argument('--use-search', action="store_true",
+                        help='update-pulls, init-pulls: only read the comments of pulls '
+                        'the search API finds approved.')
+    parser.add_argument('--stats', action="store_true",
+                        help='Add lines added, removed and files changed to the output.')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Address serve listens on. Defaults to 127.0.0.1.')
+    parser.add_argument('--port', type=int, default=8025,
+                        help='Port serve listens on. Defaults to 8025.')
+    parser.add_argument('--metrics', action="store_true",
+                        help='Print time per phase, git and API calls and counters to stderr.')
+    parser.add_argument('--metrics-json', metavar='FILE',
+                        help='Write the metrics to FILE as json.')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='Write cProfile stats to FILE, or FILE.<label> per repo '
+                        'when several run.')
 
     args = parser.parse_args()
     return args 
 
 
-def stop_time(time, hours):
-    if (datetime.datetime.now() - datetime.datetime.fromtimestamp(float(time)) > datetime.timedelta(hours=int(hours))):
-        return True
-    return False
+def since_time(hours):
+    """Returns the unix time `hours` ago, or None if hours is not set."""
+    if not hours:
+        return None
+    return int(time.time() - float(hours) * 3600)
 
 
 def main(argv):
@@ -71,48 +137,172 @@ def main(argv):
         sys.exit(0)
 
     config = parse_config(args.cf)
+    paths = config["paths"]
+    lib.grvgit.gcache.path = os.path.abspath(paths.get(
+        "cache", os.path.join(os.path.dirname(paths["database"]), "grvcache.db")))
     if args.cmd == 'list-repos':
         pretty = json.dumps(config["repos"], sort_keys=True,
                             indent=4, separators=(',', ': '))
         print pretty
         exit(0)
-    if not "label" in args:
+    if args.cmd == 'serve':
+        # Webhooks may come for any repo, so serve takes all unless told.
+        args.all = not args.label
+    if not args.label and not args.all:
         raise Exception("You must choose a repo from config.")
-    repos = [r for r in config["repos"] if r["label"] == args.label]
+    if args.all:
+        repos = config["repos"]
+    else:
+        repos = [r for r in config["repos"] if fnmatch.fnmatchcase(r["label"], args.label)]
     if not repos:
         raise Exception("You must specify a valid repo.")
 
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    failed = None
+    try:
+        with metrics.phase("total"):
+            if args.cmd == 'serve':
+                lib.grvserve.serve(config, repos, args.host, args.port)
+            elif len(repos) == 1 and not args.all:
+                run_command(args, config, repos[0])
+            else:
+                failed = run_parallel(args, config, repos)
+    finally:
+        # Flushed here rather than at exit so the write is in the metrics.
+        lib.grvgit.gcache.cache_save()
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        report_metrics(args)
+    if failed:
+        sys.exit(1)
+
+
+def report_metrics(args):
+    """Prints and writes the metrics, as asked by --metrics / --metrics-json."""
+    if args.metrics:
+        print >> sys.stderr, metrics.format()
+    if args.metrics_json:
+        metrics.dump(args.metrics_json)
+
+
+def run_parallel(args, config, repos):
+    """Runs the command for each repo in a pool of args.jobs processes.
+
+    The output of each repo is printed as one block once it is done, and
+    its log and errors go to stderr the same way. The metrics of each repo
+    are added to this process's. Returns the labels that failed.
+    """
+    pool = multiprocessing.Pool(min(args.jobs, len(repos)), maxtasksperchild=1)
+    failed = []
+    try:
+        tasks = [(args, config, repo) for repo in repos]
+        for label, out, err, ok, summary in pool.imap_unordered(_run_label, tasks):
+            metrics.merge(summary)
+            print "# %s" % label
+            sys.stdout.write(out)
+            sys.stdout.flush()
+            sys.stderr.write(err)
+            if not ok:
+                failed.append(label)
+    finally:
+        pool.close()
+        pool.join()
+    if failed:
+        logging.error("Failed: %s", ", ".join(failed))
+    return failed
+
 
+def _run_label(task):
+    """Pool worker: runs one repo with its stdout and log captured."""
+    args, config, repo = task
+    out, err = StringIO.StringIO(), StringIO.StringIO()
+    handler = logging.StreamHandler(err)
+    handler.setFormatter(logging.Formatter(
+        "%s:%%(levelname)s:%%(message)s" % repo["label"]))
+    root = logging.getLogger()
+    root.handlers = [handler]
 
-    repo = repos[0]
+    # Drop what was forked from the parent's metrics.
+    metrics.reset()
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
 
+    sys.stdout = out
+    ok = True
+    try:
+        run_command(args, config, repo)
+    except Exception:
+        logging.exception("%s failed.", args.cmd)
+        ok = False
+    finally:
+        sys.stdout = sys.__stdout__
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats("%s.%s" % (args.profile, repo["label"]))
+        # Pool workers leave through os._exit, which skips the atexit flush.
+        lib.grvgit.gcache.cache_save()
+    return repo["label"], out.getvalue(), err.getvalue(), ok, metrics.summary()
+
+
+def run_command(args, config, repo):
+    """Runs a command on one repo from config."""
+    with metrics.phase(args.cmd):
+        _run_command(args, config, repo)
+
+
+def _run_command(args, config, repo):
+    since = since_time(args.since)
     if args.cmd in ("update-pulls", "init-pulls"):
         # TODO: This validation belongs with process_args.
         gh_owner = repo["github_owner"]
         gh_repo = repo["github_repo"]
-        gh_user = config["credentials"]["github_personal_access_token"]
+        gh_user = github_tokens(config)[0]
         db_file = config["paths"]["database"]
 
+        gh_options = github_options(config)
+        review_phrases = config.get("review_phrases")
+
         if args.cmd == "update-pulls":
-            lib.operations.update_pulls(db_file, gh_user, gh_owner, gh_repo)
+            lib.operations.update_pulls(db_file, gh_user, gh_owner, gh_repo, review_phrases,
+                                        args.use_search, **gh_options)
         else:
-            lib.operations.init_pulls(db_file, gh_user, gh_owner, gh_repo)
+            lib.operations.init_pulls(db_file, gh_user, gh_owner, gh_repo, review_phrases,
+                                      args.use_search, **gh_options)
+    elif args.cmd == "recompute-reviewers":
+        changed = lib.operations.recompute_reviewers(
+            config["paths"]["database"], repo["github_owner"], repo["github_repo"],
+            config.get("review_phrases"))
+        print "Reviewers changed: %s" % changed
     elif args.cmd == "list-merge-commits":
-        commits = lib.grvgit.get_merge_commits(repo["git_repo_dir"], repo["branch"])
+        commits = lib.grvgit.get_merge_commits(repo["git_repo_dir"], repo["branch"], since,
+                                               args.stats)
         for c in commits:
-            print "%s, %s, %s" % (c.hexsha, c.parents, c.time)
+            print "%s, %s, %s%s" % (c.hexsha, c.parents, c.time, format_stats(c, args.stats))
     elif args.cmd == "list-direct-commits":
-        commits = lib.grvgit.get_direct_commits(repo["git_repo_dir"], repo["branch"])
+        commits = lib.grvgit.get_direct_commits(repo["git_repo_dir"], repo["branch"], since,
+                                                args.stats)
         for c in commits:
             date = datetime.datetime.fromtimestamp(float(c.time))
-            print "%s, %s, %s, %s, %s" % (c.hexsha, c.parents, date, c.author, c.email)
+            print "%s, %s, %s, %s, %s%s" % (c.hexsha, c.parents, date, c.author, c.email,
+                                            format_stats(c, args.stats))
     elif args.cmd == "list-all-commits":
-        commits = lib.grvgit.get_all_commits(repo["git_repo_dir"], repo["branch"])
+        commits = lib.grvgit.get_all_commits(repo["git_repo_dir"], repo["branch"], since,
+                                             args.stats)
         for c in commits:
             date = datetime.datetime.fromtimestamp(float(c.time))
-            print "%s, %s, %s, %s, %s" % (c.hexsha, c.parents, date, c.author, c.email)
+            print "%s, %s, %s, %s, %s%s" % (c.hexsha, c.parents, date, c.author, c.email,
+                                            format_stats(c, args.stats))
     elif args.cmd == "update-repo":
         print lib.grvgit.update(repo["git_repo_dir"], repo["branch"])
+        lib.operations.update_commits(config["paths"]["database"], repo["label"],
+                                      repo["git_repo_dir"], repo["branch"],
+                                      jobs=args.scan_jobs)
     elif args.cmd == "list-pulls":
         pullsdb = lib.grvdb.Pulls(config["paths"]["database"])
         all_pulls = pullsdb.readall()
@@ -122,28 +312,59 @@ def main(argv):
         gh_owner = repo["github_owner"]
         gh_repo = repo["github_repo"]
         db_file = config["paths"]["database"]
-        result = lib.operations.report_all(db_file, repo["git_repo_dir"], repo["branch"])
-        print_commits(result, args.since)
+        result = lib.operations.report_all(db_file, repo["label"], repo["git_repo_dir"],
+                                           repo["branch"], gh_owner, gh_repo, since, args.stats)
+        print_commits(result, args.stats)
+    elif args.cmd == "query":
+        reviewed = None
+        if args.reviewed:
+            reviewed = args.reviewed == "yes"
+        rows = lib.operations.query_report(config["paths"]["database"], repo["label"],
+                                           repo["github_owner"], repo["github_repo"], since,
+                                           since_time(args.until), args.author, args.type,
+                                           reviewed)
+        print_report(rows)
     elif args.cmd == "list-violations":
         gh_owner = repo["github_owner"]
         gh_repo = repo["github_repo"]
         db_file = config["paths"]["database"]
-        result = lib.operations.report_all(db_file, repo["git_repo_dir"], repo["branch"])
-        result = [x for x in result if not x.pr_reviewer]
-        print_commits(result, args.since)
+        result = lib.operations.report_violations(db_file, repo["label"], repo["git_repo_dir"],
+                                                  repo["branch"], gh_owner, gh_repo, since,
+                                                  args.stats)
+        print_commits(result, args.stats)
 
 
-def print_commits(result, since):
-        print ','.join(("Commit", "Who", "When", "What", "Reviewed", "Reviewer"))
+def format_stats(commit, stats):
+    """Returns the ", added, removed, files" suffix for list commands."""
+    if not stats:
+        return ""
+    return ", %s, %s, %s" % (commit.ct_added, commit.ct_removed, commit.ct_files)
+
+
+def print_commits(result, stats=False):
+        header = ["Commit", "Who", "When", "What", "Reviewed", "Reviewer"]
+        if stats:
+            header.extend(("Added", "Removed", "Files"))
+        print ','.join(header)
         for rec in result:
-            if since and stop_time(rec.time, since):
-                break
             t = 'direct'
             if len(rec.parents) > 1:
                 t = 'merge'
             if rec.pr_number:
                 t = 'pull'
-            print ','.join([str(x) for x in (rec.hexsha, rec.email, str(datetime.datetime.fromtimestamp(float(rec.time))), t, rec.pr_number, rec.pr_reviewer)])
+            row = [rec.hexsha, rec.email, str(datetime.datetime.fromtimestamp(float(rec.time))), t, rec.pr_number, rec.pr_reviewer]
+            if stats:
+                row.extend((rec.ct_added, rec.ct_removed, rec.ct_files))
+            print ','.join([str(x) for x in row])
+
+
+def print_report(rows):
+    """Prints report table rows in the report-all format."""
+    print ','.join(["Commit", "Who", "When", "What", "Reviewed", "Reviewer"])
+    for row in rows:
+        print ','.join([str(x) for x in (
+            row['sha'], row['email'], datetime.datetime.fromtimestamp(float(row['time'])),
+            row['type'], row['pr_number'], row['pr_reviewer'])])
 
 
 if __name__ == "__main__":
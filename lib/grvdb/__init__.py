@@ -1,4 +1,12 @@
 # __init__.py
+import commits
+import db
+import issuecomments
 import pulls
+import reports
 
-Pulls = pulls.Pulls
\ No newline at end of file
+Commits = commits.Commits
+connect = db.connect
+IssueComments = issuecomments.IssueComments
+Pulls = pulls.Pulls
+Reports = reports.Reports
@@ -2,187 +2,188 @@
 test with python -m lib.grvdb.commits
 '''
 
-import sqlite3
 import logging
+import json
 
+import lib.grvdb.db
 import lib.grvtypes
+from lib.grvmetrics import metrics
+
+
+# Version 1 of the tables, see lib.grvdb.db.
+SCHEMA = [
+    '''create table IF NOT EXISTS commits
+        (id INTEGER PRIMARY KEY, label text, sha text,
+        parents text, author text, email text, time int, ct_added int,
+        ct_removed int, ct_files int, files text, pr_number text,
+        pr_reviewer text, parent1 text, parent2 text, ct_parents int)''',
+    '''create unique index IF NOT EXISTS commits_label_sha
+        on commits (label, sha)''',
+    '''create index IF NOT EXISTS commits_label_id
+        on commits (label, id)''',
+    '''create index IF NOT EXISTS commits_label_time
+        on commits (label, time)''',
+    '''create table IF NOT EXISTS heads
+        (label text PRIMARY KEY, head_sha text, updated timestamp)''',
+    ]
 
 
 class Commits(object):
+    """First-parent history of each label, oldest first by id.
+
+    The heads table holds the sha each label was last scanned up to, so
+    a scan only has to walk the commits added since.
+    """
 
     def __init__(self, db):
-        self.conn = sqlite3.connect(db, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
-        self.conn.row_factory = sqlite3.Row
-        c = self.conn.cursor()
-        c.execute('''create table IF NOT EXISTS commits 
-            (id INTEGER PRIMARY KEY, gh_owner text, gh_repo, sha text, 
-            parents text, author timestamp, ct_added int,
-            ct_removed int, ct_files int, files text, pr_number text,
-            pr_reviewer text, parent1 text, parent2 text, ct_parents)''')
-        self.conn.commit()
-        c.close()
-        pulls = self.readall()
-
-    def _to_type(self, pull):
-        """Reads a hash, converts to pull type.
-
-        Commit = collections.namedtuple("Commit", (
-                'hexsha',
-                'parents',
-                'author',
-                'email',
-                'time',
-                'ct_added',
-                'ct_removed',
-                'ct_files',
-                'files',
-                'pr_number',
-                'pr_reviewer'
-        """
-        tpull = lib.grvtypes.IssueComment(
-                gh_owner=pull['gh_owner'],
-                gh_repo=pull['gh_repo'],
-                gh_user=pull['gh_user'],
-                gh_user_id=pull['gh_user_id'],
-                update_time=pull['update_time'],
-                create_time=pull['create_time'],
-                comment_id=pull['comment_id'],
-                issue_number=pull['issue_number'],
-                body=pull['body']
+        self.conn = lib.grvdb.db.connect(db)
+
+    def _to_type(self, commit):
+        """Reads a hash, converts to commit type."""
+        tcommit = lib.grvtypes.Commit(
+            hexsha=commit['sha'],
+            parents=tuple(commit['parents'].split(' ')),
+            author=commit['author'],
+            email=commit['email'],
+            time=commit['time'],
+            ct_added=commit['ct_added'],
+            ct_removed=commit['ct_removed'],
+            ct_files=commit['ct_files'],
+            files=json.loads(commit['files']) if commit['files'] else None,
+            pr_number=commit['pr_number'],
+            pr_reviewer=commit['pr_reviewer']
             )
-        return tpull
+        return tcommit
 
-    def readall(self):
-        c = self.conn.cursor()
-        c.execute("SELECT * FROM issuecomments")
-        return [self._to_type(p) for p in c.fetchall()]
+    def get_for_label(self, label, since=None):
+        """Yields the commits of label, newest first.
 
-    def get_for_repo(self, gh_owner, gh_repo):
-        """Looks up all for repo object."""
+        If since is set, only commits from that unix time on.
+        """
         c = self.conn.cursor()
-        c.execute("SELECT * FROM issuecomments where gh_repo=? and gh_owner=?",
-            (gh_repo, gh_owner))
-        return [self._to_type(p) for p in c.fetchall()]
+        if since:
+            c.execute("SELECT * FROM commits WHERE label=? AND time>=? ORDER BY id DESC",
+                      (label, since))
+        else:
+            c.execute("SELECT * FROM commits WHERE label=? ORDER BY id DESC", (label,))
+        for row in c:
+            yield self._to_type(row)
+        c.close()
+
+    def add_commits(self, label, commits, head_sha, batch_size=1000):
+        """Appends commits, oldest first, and moves the label's head.
 
-    def add(self, ci):
-        """Add a CI.
         Args:
-          pull: A lib.grvtypes.CommentIssue object.
+          label: the repo label from config.
+          commits: iterable of lib.grvtypes.Commit, oldest first.
+          head_sha: the sha the scan ran up to.
+          batch_size: rows written per transaction.
         Return:
-          None
+          The number of commits added.
         """
-        gh_owner= ci.gh_owner
-        gh_repo= ci.gh_repo
-        gh_user= ci.gh_user
-        gh_user_id= ci.gh_user_id
-        update_time= ci.update_time
-        create_time= ci.create_time
-        comment_id= ci.comment_id
-        issue_number= ci.issue_number
-        body= ci.body
-
+        count = 0
+        batch = []
+        for commit in commits:
+            batch.append(commit)
+            if len(batch) >= batch_size:
+                count += self._insert(label, batch)
+                batch = []
+        count += self._insert(label, batch)
+
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO heads VALUES (?,?,datetime('now'))",
+                              (label, head_sha))
+        logging.info("Added %s commits to %s, head %s", count, label, head_sha)
+        return count
+
+    def _insert(self, label, commits):
+        rows = []
+        for commit in commits:
+            parents = commit.parents
+            rows.append((
+                label, commit.hexsha, ' '.join(parents), commit.author,
+                commit.email, int(commit.time), commit.ct_added,
+                commit.ct_removed, commit.ct_files,
+                json.dumps(commit.files) if commit.files is not None else None,
+                commit.pr_number, commit.pr_reviewer, parents[0],
+                parents[1] if len(parents) > 1 else None, len(parents)))
+        if not rows:
+            return 0
+        with metrics.timer("sqlite commits insert"), self.conn:
+            # A scan interrupted before its head was saved is walked
+            # again, so rows already stored are skipped.
+            c = self.conn.executemany(
+                "INSERT OR IGNORE INTO commits VALUES "
+                "(NULL,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", rows)
+        metrics.count("db.commits_written", c.rowcount)
+        return c.rowcount
+
+    def get_head(self, label):
+        """Returns the sha label was last scanned up to, or None."""
         c = self.conn.cursor()
-
-        # Store updates as new issuecomment to retain old ones.
-        logging.info("Creating")
-        c.execute("INSERT INTO issuecomments VALUES (NULL,?,?,?,?,?,?,?,?,?)", (
-                    gh_owner, gh_repo, gh_user, 
-                    gh_user_id, update_time , create_time,
-                    comment_id, issue_number, body))
-        self.conn.commit()
-        c.close()
-
-    def get_last_update(self):
-        c = self.conn.cursor()
-        c.execute("SELECT * FROM issuecomments ORDER BY update_time DESC LIMIT 1")
+        c.execute("SELECT head_sha FROM heads WHERE label=?", (label,))
         last = c.fetchone()
+        c.close()
         if last:
-            return last['update_time']
+            return last['head_sha']
         return None
 
+    def clear(self, label):
+        """Drops the stored history and head of label."""
+        with self.conn:
+            self.conn.execute("DELETE FROM commits WHERE label=?", (label,))
+            self.conn.execute("DELETE FROM heads WHERE label=?", (label,))
+
 
 if __name__ == "__main__":
     # All of these are unittests.
     # TODO(jondb): Move these to unittest.
-    # run with python -m lib.grvdb.pulls
-    import datetime
+    # run with python -m lib.grvdb.commits
+    import os
     logging.basicConfig(level=logging.DEBUG)
 
-    logging.info("Testing IssueComment class.")
-    icdb = IssueComments("test.db")
-
-    logging.info("Reading all IssueComments.")
-    ics = icdb.readall()
-    assert len(ics) == 0
-
-    logging.info("Adding an IC.")
-    now = datetime.datetime.utcnow()
-    tpull = lib.grvtypes.IssueComment(
-        gh_owner="repoowner",
-        gh_repo="reponame2",
-        gh_user="CommentAuthor",
-        gh_user_id="CommentAuthorID",
-        update_time=now,
-        create_time=now,
-        comment_id="11",
-        issue_number="2443",
-        body="Hi There"
-        )
-    icdb.add(tpull)
-
-    logging.info("Adding an old pull.")
-    tpull = lib.grvtypes.IssueComment(
-        gh_owner="repoowner",
-        gh_repo="reponame",
-        gh_user="CommentAuthor",
-        gh_user_id="CommentAuthorID",
-        update_time=datetime.datetime(2014, 11, 14, 6, 35, 46),
-        create_time=datetime.datetime(2014, 11, 14, 6, 35, 46),
-        comment_id="13",
-        issue_number="2443",
-        body="Hi There earlier."
-        )
-    icdb.add(tpull)
-
-    logging.info("Reading that it was added.")
-    icdb = IssueComments("test.db")
-    pulls = icdb.readall()
-    assert len(pulls) == 2
-
-    latest_update = datetime.datetime.utcnow()
-    logging.info("Trying to update")
-    tpull = lib.grvtypes.IssueComment(
-        gh_owner="repoowner",
-        gh_repo="reponame",
-        gh_user="CommentAuthor",
-        gh_user_id="CommentAuthorID",
-        update_time=latest_update,
-        create_time=datetime.datetime(2014, 11, 14, 6, 35, 46),
-        comment_id="13",
-        issue_number="2443",
-        body="Hi There earlier."
+    logging.info("Testing commits class.")
+    cdb = Commits("test.db")
+
+    logging.info("Reading an empty label.")
+    assert cdb.get_head("label1") is None
+    assert len(list(cdb.get_for_label("label1"))) == 0
+
+    logging.info("Adding commits.")
+    first = lib.grvtypes.Commit(
+        hexsha="aaa",
+        parents=("",),
+        author="test user",
+        email="test@example.com",
+        time="1416000000",
+        ct_added=1,
+        ct_removed=0,
+        ct_files=1,
+        files=["a.txt"],
+        pr_number=None,
+        pr_reviewer=None,
         )
-    icdb.add(tpull)
-
-    pulls = icdb.readall()
-    assert len(pulls) == 3
-    pull = None
-    for pull in pulls:
-        if pull.comment_id == 13:
-            assert pull.gh_user == "jo bob"
-
-    logging.info("Testing get last updated")
-    last_update = icdb.get_last_update()
-    logging.info("now: %s, last: %s", now, last_update)
-    assert (last_update == latest_update)
-
-    logging.info("Testing get_pulls_for_gh_repo")
-    
-    pulls = icdb.get_for_repo(gh_owner="repoowner", gh_repo="reponame2")
-    assert len(pulls) == 1
-
-    logging.info("Dropping the table.")
-    c = icdb.conn.cursor()
-    c.execute("Drop table issuecomments")
-    icdb.conn.commit()
-    c.close()
+    merge = first._replace(hexsha="ccc", parents=("aaa", "bbb"), time="1416000100")
+    assert cdb.add_commits("label1", [first, merge], "ccc", batch_size=1) == 2
+    assert cdb.get_head("label1") == "ccc"
+
+    logging.info("Reading them newest first.")
+    commits = list(cdb.get_for_label("label1"))
+    assert [c.hexsha for c in commits] == ["ccc", "aaa"]
+    assert commits[0].parents == ("aaa", "bbb")
+    assert commits[1].files == ["a.txt"]
+    commits = list(cdb.get_for_label("label1", since=1416000050))
+    assert [c.hexsha for c in commits] == ["ccc"]
+
+    logging.info("Adding a commit twice is ignored.")
+    assert cdb.add_commits("label1", [merge], "ccc") == 0
+    assert len(list(cdb.get_for_label("label1"))) == 2
+
+    logging.info("Clearing the label.")
+    cdb.clear("label1")
+    assert cdb.get_head("label1") is None
+    assert len(list(cdb.get_for_label("label1"))) == 0
+
+    logging.info("Removing the database.")
+    lib.grvdb.db.close("test.db")
+    os.remove("test.db")
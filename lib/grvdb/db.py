@@ -0,0 +1,155 @@
+'''
+The sqlite connection shared by the classes of lib.grvdb.
+
+test with python -m lib.grvdb.db
+'''
+
+import os
+import sqlite3
+import threading
+import logging
+
+from lib.grvmetrics import metrics
+
+
+_local = threading.local()
+
+
+def _migrations():
+    """The schema, one list of statements per version.
+
+    Version 1 is the tables each class used to create when it was opened,
+    so a database made before the schema was versioned goes through it as
+    a no-op. Add a version to change the schema; never edit an old one.
+    """
+    # The classes import this module, so they are read only when needed.
+    import lib.grvdb.commits
+    import lib.grvdb.issuecomments
+    import lib.grvdb.pulls
+    import lib.grvdb.reports
+    return [
+        (lib.grvdb.commits.SCHEMA + lib.grvdb.pulls.SCHEMA +
+         lib.grvdb.issuecomments.SCHEMA + lib.grvdb.reports.SCHEMA),
+        [
+            # The newest pull of a repo, where a pull sync starts.
+            '''create index IF NOT EXISTS pulls_repo_updated
+                on pulls (gh_owner, gh_repo, pull_updated)''',
+            '''create index IF NOT EXISTS pulls_updated on pulls (pull_updated)''',
+        ],
+    ]
+
+
+def migrate(conn):
+    """Brings the schema of conn up to the latest version.
+
+    The version is kept in PRAGMA user_version, so a database already up
+    to date costs one pragma read. Versions are applied in one IMMEDIATE
+    transaction, so two processes opening a new database do not both run
+    them.
+
+    Return:
+        The schema version.
+    """
+    migrations = _migrations()
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= len(migrations):
+        return version
+
+    # Transactional DDL needs sqlite's own transactions, not the module's.
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        with metrics.timer("sqlite migrate"):
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                for version, statements in enumerate(migrations[version:], version + 1):
+                    for statement in statements:
+                        conn.execute(statement)
+                    conn.execute("PRAGMA user_version=%d" % version)
+                    logging.info("Database schema at version %s.", version)
+                conn.execute("COMMIT")
+            except:
+                conn.execute("ROLLBACK")
+                raise
+    finally:
+        conn.isolation_level = isolation_level
+    return version
+
+
+def _open(path):
+    conn = sqlite3.connect(path, timeout=60,
+                           detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+    conn.row_factory = sqlite3.Row
+    # Readers see the last commit and do not block the writer. Both are
+    # kept by the file, so this only changes a new database.
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    migrate(conn)
+    metrics.count("db.connections")
+    return conn
+
+
+def _connections():
+    # A forked process must not use the connections of its parent.
+    if getattr(_local, "pid", None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.connections = {}
+    return _local.connections
+
+
+def connect(path):
+    """Returns the connection to the database at path.
+
+    It is opened, and its schema migrated, the first time a thread asks
+    for it; the classes of lib.grvdb opened on the same file share it
+    after that, with its cache of prepared statements.
+    """
+    connections = _connections()
+    key = os.path.abspath(path)
+    conn = connections.get(key)
+    if conn is None:
+        conn = connections[key] = _open(path)
+    return conn
+
+
+def close(path):
+    """Closes the connection of this thread to the database at path, if open."""
+    conn = _connections().pop(os.path.abspath(path), None)
+    if conn is not None:
+        conn.close()
+
+
+if __name__ == "__main__":
+    # All of these are unittests.
+    # TODO(jondb): Move these to unittest.
+    # run with python -m lib.grvdb.db
+    logging.basicConfig(level=logging.DEBUG)
+
+    logging.info("Testing db module.")
+    latest = len(_migrations())
+    conn = connect("test.db")
+    assert connect("./test.db") is conn
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == latest
+    assert migrate(conn) == latest
+
+    logging.info("Another thread gets its own connection.")
+    other = []
+    thread = threading.Thread(target=lambda: other.append(connect("test.db")))
+    thread.start()
+    thread.join()
+    assert other[0] is not conn
+
+    logging.info("An older database is brought up to date.")
+    conn.execute("DROP INDEX pulls_repo_updated")
+    conn.execute("PRAGMA user_version=1")
+    close("test.db")
+    conn = connect("test.db")
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == latest
+    assert conn.execute("SELECT 1 FROM sqlite_master WHERE type='index' "
+                        "AND name='pulls_repo_updated'").fetchone()
+
+    logging.info("Removing the database.")
+    close("test.db")
+    os.remove("test.db")
@@ -0,0 +1,172 @@
+'''
+test with python -m lib.grvdb.issuecomments
+'''
+
+import collections
+import logging
+
+import lib.grvdb.db
+import lib.grvtypes
+from lib.grvmetrics import metrics
+
+
+# Version 1 of the tables, see lib.grvdb.db.
+SCHEMA = [
+    '''create table IF NOT EXISTS issuecomments
+        (id INTEGER PRIMARY KEY, gh_owner text, gh_repo text, gh_user text,
+        gh_user_id text, update_time timestamp, create_time timestamp,
+        comment_id int, issue_number text, body text)''',
+    '''create unique index IF NOT EXISTS issuecomments_comment
+        on issuecomments (gh_owner, gh_repo, comment_id)''',
+    '''create index IF NOT EXISTS issuecomments_issue
+        on issuecomments (gh_owner, gh_repo, issue_number, update_time)''',
+    ]
+
+
+class IssueComments(object):
+    """Comments of pulls, kept so reviewers can be worked out offline.
+
+    A comment is stored once per comment_id; an edited comment replaces
+    the stored one.
+    """
+
+    def __init__(self, db):
+        self.conn = lib.grvdb.db.connect(db)
+
+    def _to_type(self, comment):
+        """Reads a hash, converts to IssueComment type."""
+        tcomment = lib.grvtypes.IssueComment(
+            gh_owner=comment['gh_owner'],
+            gh_repo=comment['gh_repo'],
+            gh_user=comment['gh_user'],
+            gh_user_id=comment['gh_user_id'],
+            update_time=comment['update_time'],
+            create_time=comment['create_time'],
+            comment_id=comment['comment_id'],
+            issue_number=comment['issue_number'],
+            body=comment['body']
+            )
+        return tcomment
+
+    def get_for_issue(self, gh_owner, gh_repo, issue_number):
+        """Returns the comments of an issue or pull, oldest first."""
+        c = self.conn.cursor()
+        c.execute("SELECT * FROM issuecomments WHERE gh_owner=? AND gh_repo=? "
+                  "AND issue_number=? ORDER BY create_time, comment_id",
+                  (gh_owner, gh_repo, str(issue_number)))
+        return [self._to_type(r) for r in c.fetchall()]
+
+    def get_for_repo(self, gh_owner, gh_repo):
+        """Yields (issue_number, comments oldest first) for each issue of repo."""
+        c = self.conn.cursor()
+        c.execute("SELECT * FROM issuecomments WHERE gh_owner=? AND gh_repo=? "
+                  "ORDER BY issue_number, create_time, comment_id", (gh_owner, gh_repo))
+        number, comments = None, []
+        for row in c:
+            if row['issue_number'] != number and comments:
+                yield number, comments
+                comments = []
+            number = row['issue_number']
+            comments.append(self._to_type(row))
+        if comments:
+            yield number, comments
+        c.close()
+
+    def get_last_updates(self, gh_owner, gh_repo):
+        """Returns a dict of issue number to its newest stored update_time."""
+        c = self.conn.cursor()
+        c.execute("SELECT issue_number, MAX(update_time) AS 'last [timestamp]' "
+                  "FROM issuecomments WHERE gh_owner=? AND gh_repo=? GROUP BY issue_number",
+                  (gh_owner, gh_repo))
+        return dict((int(r['issue_number']), r['last']) for r in c.fetchall())
+
+    def add_comments(self, comments):
+        """Adds or replaces comments, in one transaction.
+        Args:
+          comments: An iterable of lib.grvtypes.IssueComment objects.
+        Return:
+          The number of comments written.
+        """
+        # The last of a comment wins.
+        by_key = collections.OrderedDict()
+        for ic in comments:
+            by_key[(ic.gh_owner, ic.gh_repo, ic.comment_id)] = ic
+        rows = [(ic.gh_owner, ic.gh_repo, ic.gh_user, ic.gh_user_id, ic.update_time,
+                 ic.create_time, ic.comment_id, str(ic.issue_number), ic.body)
+                for ic in by_key.itervalues()]
+        if not rows:
+            return 0
+        # An update and an insert rather than ON CONFLICT, which needs
+        # sqlite 3.24.
+        with metrics.timer("sqlite issuecomments upsert"), self.conn:
+            self.conn.executemany(
+                "UPDATE issuecomments SET gh_user=?, gh_user_id=?, update_time=?, "
+                "create_time=?, issue_number=?, body=? "
+                "WHERE gh_owner=? AND gh_repo=? AND comment_id=?",
+                [(r[2], r[3], r[4], r[5], r[7], r[8], r[0], r[1], r[6]) for r in rows])
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO issuecomments VALUES (NULL,?,?,?,?,?,?,?,?,?)", rows)
+        metrics.count("db.comments_written", len(rows))
+        return len(rows)
+
+    def delete_comment(self, gh_owner, gh_repo, comment_id):
+        with self.conn:
+            self.conn.execute("DELETE FROM issuecomments WHERE gh_owner=? AND gh_repo=? "
+                              "AND comment_id=?", (gh_owner, gh_repo, comment_id))
+
+
+if __name__ == "__main__":
+    # All of these are unittests.
+    # TODO(jondb): Move these to unittest.
+    # run with python -m lib.grvdb.issuecomments
+    import datetime
+    import os
+    logging.basicConfig(level=logging.DEBUG)
+
+    logging.info("Testing IssueComments class.")
+    icdb = IssueComments("test.db")
+
+    logging.info("Reading an empty repo.")
+    assert list(icdb.get_for_repo("repoowner", "reponame")) == []
+    assert icdb.get_last_updates("repoowner", "reponame") == {}
+
+    logging.info("Adding comments.")
+    then = datetime.datetime(2014, 11, 14, 6, 35, 46)
+    now = datetime.datetime(2014, 11, 15, 6, 35, 46)
+    first = lib.grvtypes.IssueComment(
+        gh_owner="repoowner",
+        gh_repo="reponame",
+        gh_user="CommentAuthor",
+        gh_user_id="CommentAuthorID",
+        update_time=then,
+        create_time=then,
+        comment_id=13,
+        issue_number=2443,
+        body="Hi There earlier."
+        )
+    second = first._replace(comment_id=14, update_time=now, create_time=now, body="LGTM")
+    other = first._replace(gh_repo="reponame2", comment_id=11)
+    assert icdb.add_comments([second, first, other]) == 3
+
+    logging.info("Reading them oldest first.")
+    comments = icdb.get_for_issue("repoowner", "reponame", 2443)
+    assert [c.comment_id for c in comments] == [13, 14]
+    assert comments[0].create_time == then
+    assert [(n, len(cs)) for n, cs in icdb.get_for_repo("repoowner", "reponame")] == [
+        ("2443", 2)]
+    assert icdb.get_last_updates("repoowner", "reponame") == {2443: now}
+
+    logging.info("An edited comment replaces the stored one.")
+    later = datetime.datetime(2014, 11, 16, 6, 35, 46)
+    icdb.add_comments([first._replace(update_time=later, body="Edited.")])
+    comments = icdb.get_for_issue("repoowner", "reponame", 2443)
+    assert [c.body for c in comments] == ["Edited.", "LGTM"]
+    assert icdb.get_last_updates("repoowner", "reponame") == {2443: later}
+
+    logging.info("Deleting a comment.")
+    icdb.delete_comment("repoowner", "reponame", 14)
+    assert [c.comment_id for c in icdb.get_for_issue("repoowner", "reponame", 2443)] == [13]
+
+    logging.info("Removing the database.")
+    lib.grvdb.db.close("test.db")
+    os.remove("test.db")
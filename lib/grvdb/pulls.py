@@ -1,23 +1,40 @@
-import sqlite3
 import logging
 
+import lib.grvdb.db
 import lib.grvtypes
+from lib.grvmetrics import metrics
+
+
+# Version 1 of the tables, see lib.grvdb.db.
+SCHEMA = [
+    '''create table IF NOT EXISTS pulls
+        (id INTEGER PRIMARY KEY, gh_owner text, gh_repo text,
+            pull_number text, pull_requester text, base_sha text, head_sha text,
+        pull_reviewer text, merge_time timestamp, pull_title text,
+        pull_updated timestamp, merge_sha, work_tickets)''',
+    # Older databases could hold a pull more than once; keep the latest
+    # row so the unique index can be built.
+    '''DELETE FROM pulls WHERE id NOT IN (SELECT MAX(id) FROM pulls
+        GROUP BY gh_owner, gh_repo, pull_number)''',
+    '''create unique index IF NOT EXISTS pulls_number
+        on pulls (gh_owner, gh_repo, pull_number)''',
+    "create index IF NOT EXISTS pulls_head on pulls (head_sha)",
+    "create index IF NOT EXISTS pulls_merge on pulls (merge_sha)",
+    '''create table IF NOT EXISTS pull_sync
+        (gh_owner text, gh_repo text, watermark timestamp, page int, per_page int,
+        stop timestamp, target timestamp, updated timestamp,
+        PRIMARY KEY (gh_owner, gh_repo))''',
+    '''create table IF NOT EXISTS review_windows
+        (gh_owner text, gh_repo text, query text, since timestamp, until timestamp,
+        searched timestamp, reviewed text,
+        PRIMARY KEY (gh_owner, gh_repo, query, since))''',
+    ]
 
 
 class Pulls(object):
 
     def __init__(self, db):
-        self.conn = sqlite3.connect(db, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
-        self.conn.row_factory = sqlite3.Row
-        c = self.conn.cursor()
-        c.execute('''create table IF NOT EXISTS pulls 
-            (id INTEGER PRIMARY KEY, gh_owner text, gh_repo text,
-                pull_number text, pull_requester text, base_sha text, head_sha text,
-            pull_reviewer text, merge_time timestamp, pull_title text, 
-            pull_updated timestamp, merge_sha, work_tickets)''')
-        self.conn.commit()
-        c.close()
-        pulls = self.readall()
+        self.conn = lib.grvdb.db.connect(db)
 
     def _to_pull_type(self, pull):
         """Reads a hash, converts to pull type."""
@@ -56,47 +73,178 @@ class Pulls(object):
         Return:
           None
         """
+        self.add_pulls([pull])
 
-        gh_owner = pull.gh_owner
-        gh_repo = pull.gh_repo
-        pull_number = pull.pull_number
-        pull_requester = pull.pull_requester
-        base_sha = pull.base_sha
-        head_sha = pull.head_sha
-        pull_reviewer = pull.pull_reviewer
-        merge_time = pull.merge_time
-        pull_title = pull.pull_title
-        pull_updated = pull.pull_updated
-        merge_sha = pull.merge_sha
-        work_tickets = pull.work_tickets
+    def add_pulls(self, pulls, batch_size=500):
+        """Add or update PRs, one transaction per batch.
+        Args:
+          pulls: An iterable of lib.types.pull objects.
+          batch_size: pulls written per transaction.
+        Return:
+          A (inserted, updated) tuple of row counts.
+        """
+        inserted, updated = 0, 0
+        batch = []
+        for pull in pulls:
+            batch.append(pull)
+            if len(batch) >= batch_size:
+                ct_inserted, ct_updated = self._upsert(batch)
+                inserted, updated = inserted + ct_inserted, updated + ct_updated
+                batch = []
+        ct_inserted, ct_updated = self._upsert(batch)
+        inserted, updated = inserted + ct_inserted, updated + ct_updated
+        logging.info("Pulls inserted: %s, updated: %s", inserted, updated)
+        return inserted, updated
 
+    def _upsert(self, pulls):
+        if not pulls:
+            return 0, 0
         c = self.conn.cursor()
-        # UPDATE?
-        c.execute("SELECT 1 FROM pulls WHERE pull_number=? AND "
-                  "gh_repo=? AND gh_owner=?", (pull_number, gh_repo, gh_owner))
-        exists = c.fetchone()
-        logging.info("updated: %s", pull_updated)
-
-        if exists:
-            logging.info("Updating")
-            c.execute("UPDATE pulls SET pull_requester=?, base_sha=?, head_sha=?, pull_reviewer=?, "
-                      "merge_time=?, pull_title=?, pull_updated=?, "
-                      "merge_sha=?, work_tickets=? "
-                      "WHERE pull_number=? AND gh_repo=? AND gh_owner=?",
-                      (pull_requester, base_sha, head_sha, pull_reviewer, merge_time, pull_title, pull_updated,
-                       merge_sha, work_tickets, pull_number, gh_repo, gh_owner))
-        else:
-            logging.info("Creating")
-            c.execute("INSERT INTO pulls VALUES (NULL,?,?,?,?,?,?,?,?,?,?,?,?)", (
-                      gh_owner, gh_repo, pull_number, pull_requester, base_sha, head_sha, 
-                      pull_reviewer, merge_time, pull_title, pull_updated,
-                      merge_sha, work_tickets))
-        self.conn.commit()
+
+        # Count the pulls already stored, by the unique index.
+        by_repo = {}
+        for pull in pulls:
+            by_repo.setdefault((pull.gh_owner, pull.gh_repo), set()).add(
+                str(pull.pull_number))
+        seen = set()
+        for (gh_owner, gh_repo), numbers in by_repo.iteritems():
+            numbers = list(numbers)
+            c.execute("SELECT pull_number FROM pulls WHERE gh_owner=? AND gh_repo=? "
+                      "AND pull_number IN (%s)" % ','.join('?' * len(numbers)),
+                      [gh_owner, gh_repo] + numbers)
+            seen.update((gh_owner, gh_repo, r['pull_number']) for r in c.fetchall())
+
+        inserted, updated = 0, 0
+        new_rows, changed_rows = [], []
+        for pull in pulls:
+            key = (pull.gh_owner, pull.gh_repo, str(pull.pull_number))
+            row = (pull.pull_requester, pull.base_sha, pull.head_sha, pull.pull_reviewer,
+                   pull.merge_time, pull.pull_title, pull.pull_updated, pull.merge_sha,
+                   pull.work_tickets)
+            if key in seen:
+                updated += 1
+                changed_rows.append(row + key)
+            else:
+                inserted += 1
+                seen.add(key)
+                new_rows.append(key + row)
+
+        # An insert and an update rather than ON CONFLICT, which needs
+        # sqlite 3.24. The insert has no OR clause, as that would override
+        # the INSERT OR REPLACE of the report triggers. Updates run in
+        # order, so the last of a pull wins.
+        with metrics.timer("sqlite pulls upsert"), self.conn:
+            c.executemany(
+                "INSERT INTO pulls SELECT NULL,?,?,?,?,?,?,?,?,?,?,?,? WHERE NOT EXISTS "
+                "(SELECT 1 FROM pulls WHERE gh_owner=? AND gh_repo=? AND pull_number=?)",
+                [row + row[:3] for row in new_rows])
+            c.executemany(
+                "UPDATE pulls SET pull_requester=?, base_sha=?, head_sha=?, pull_reviewer=?, "
+                "merge_time=?, pull_title=?, pull_updated=?, merge_sha=?, work_tickets=? "
+                "WHERE gh_owner=? AND gh_repo=? AND pull_number=?", changed_rows)
         c.close()
+        metrics.count("db.pulls_inserted", inserted)
+        metrics.count("db.pulls_updated", updated)
+        return inserted, updated
 
-    def get_last_update(self):
+    def set_reviewers(self, gh_owner, gh_repo, reviewers):
+        """Sets the reviewer of pulls, in one transaction.
+        Args:
+          reviewers: An iterable of (pull_number, reviewer) tuples.
+        Return:
+          The number of pulls whose reviewer changed.
+        """
+        rows = [(reviewer, gh_owner, gh_repo, str(number), reviewer)
+                for number, reviewer in reviewers]
+        with self.conn:
+            c = self.conn.executemany(
+                "UPDATE pulls SET pull_reviewer=? WHERE gh_owner=? AND gh_repo=? "
+                "AND pull_number=? AND pull_reviewer IS NOT ?", rows)
+        return c.rowcount
+
+    def get_updated(self, gh_owner, gh_repo, numbers):
+        """Returns a dict of pull number to pull_updated, for those stored."""
+        numbers = [str(n) for n in numbers]
+        if not numbers:
+            return {}
         c = self.conn.cursor()
-        c.execute("SELECT * FROM pulls ORDER BY pull_updated DESC LIMIT 1")
+        c.execute("SELECT pull_number, pull_updated FROM pulls WHERE gh_owner=? AND gh_repo=? "
+                  "AND pull_number IN (%s)" % ','.join('?' * len(numbers)),
+                  [gh_owner, gh_repo] + numbers)
+        res = dict((int(r['pull_number']), r['pull_updated']) for r in c.fetchall())
+        c.close()
+        return res
+
+    def get_pull(self, gh_owner, gh_repo, number):
+        """Returns the stored lib.grvtypes.Pull, or None."""
+        c = self.conn.cursor()
+        c.execute("SELECT * FROM pulls WHERE gh_owner=? AND gh_repo=? AND pull_number=?",
+                  (gh_owner, gh_repo, str(number)))
+        row = c.fetchone()
+        c.close()
+        if row:
+            return self._to_pull_type(row)
+        return None
+
+    def get_sync(self, gh_owner, gh_repo):
+        """Returns the lib.grvtypes.PullSync of a repo.
+
+        watermark is the pull_updated every pull up to is stored. page is
+        the next page of an unfinished pass, which stops at pulls updated
+        before stop, and moves the watermark to target once done. A repo
+        never synced has the newest pull stored for it as watermark.
+        """
+        c = self.conn.cursor()
+        c.execute("SELECT * FROM pull_sync WHERE gh_owner=? AND gh_repo=?", (gh_owner, gh_repo))
+        row = c.fetchone()
+        c.close()
+        if row:
+            return lib.grvtypes.PullSync(gh_owner, gh_repo, row['watermark'], row['page'],
+                                         row['per_page'], row['stop'], row['target'])
+        return lib.grvtypes.PullSync(gh_owner, gh_repo, self.get_last_update(gh_owner, gh_repo),
+                                     None, None, None, None)
+
+    def save_sync(self, sync):
+        """Stores a lib.grvtypes.PullSync, in its own transaction."""
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO pull_sync VALUES "
+                              "(?,?,?,?,?,?,?,datetime('now'))", sync)
+
+    def get_review_windows(self, gh_owner, gh_repo, query, since, until):
+        """Returns the lib.grvtypes.ReviewWindows of query within [since, until)."""
+        c = self.conn.cursor()
+        c.execute("SELECT * FROM review_windows WHERE gh_owner=? AND gh_repo=? AND query=? "
+                  "AND since>=? AND until<=? ORDER BY since",
+                  (gh_owner, gh_repo, query, since, until))
+        windows = [lib.grvtypes.ReviewWindow(
+            gh_owner, gh_repo, query, r['since'], r['until'], r['searched'],
+            frozenset(int(n) for n in r['reviewed'].split())) for r in c.fetchall()]
+        c.close()
+        return windows
+
+    def save_review_windows(self, windows):
+        """Stores lib.grvtypes.ReviewWindows of one repo and query, replacing
+        the windows stored within the span they cover."""
+        if not windows:
+            return
+        first = windows[0]
+        with self.conn:
+            self.conn.execute("DELETE FROM review_windows WHERE gh_owner=? AND gh_repo=? "
+                              "AND query=? AND since>=? AND until<=?",
+                              (first.gh_owner, first.gh_repo, first.query,
+                               min(w.since for w in windows), max(w.until for w in windows)))
+            self.conn.executemany("INSERT OR REPLACE INTO review_windows VALUES (?,?,?,?,?,?,?)",
+                                  [w._replace(reviewed=" ".join(str(n) for n in sorted(w.reviewed)))
+                                   for w in windows])
+
+    def get_last_update(self, gh_owner=None, gh_repo=None):
+        """Returns the newest pull_updated, of a repo if given."""
+        c = self.conn.cursor()
+        if gh_owner:
+            c.execute("SELECT * FROM pulls WHERE gh_owner=? AND gh_repo=? "
+                      "ORDER BY pull_updated DESC LIMIT 1", (gh_owner, gh_repo))
+        else:
+            c.execute("SELECT * FROM pulls ORDER BY pull_updated DESC LIMIT 1")
         last = c.fetchone()
         if last:
             return last['pull_updated']
@@ -108,6 +256,7 @@ if __name__ == "__main__":
     # TODO(jondb): Move these to unittest.
     # run with python -m lib.grvdb.pulls
     import datetime
+    import os
     logging.basicConfig(level=logging.DEBUG)
 
     logging.info("Testing pulls class.")
@@ -176,6 +325,11 @@ if __name__ == "__main__":
 
     pulls = pdb.readall()
     assert len(pulls) == 2
+
+    logging.info("Adding a batch")
+    new_pull = tpull._replace(pull_number="12")
+    assert pdb.add_pulls([tpull, new_pull, new_pull], batch_size=2) == (1, 2)
+    assert len(pdb.readall()) == 3
     pull = None
     for pull in pulls:
         if pull.pull_number == 11:
@@ -187,14 +341,62 @@ if __name__ == "__main__":
     logging.info("now: %s, last: %s", now, last_update)
     assert (last_update == now)
 
+    assert pdb.get_last_update("owner1", "gh_repo1") == now
+    assert pdb.get_last_update("owner", "gh_repo") < now
+
+    assert pdb.get_updated("owner", "gh_repo", [11, 99]) == {
+        11: datetime.datetime(2014, 11, 14, 6, 35, 46)}
+    assert pdb.get_pull("owner", "gh_repo", 11).pull_reviewer == "jo bob"
+    assert pdb.get_pull("owner", "gh_repo", 99) is None
+
+    logging.info("Testing the sync state")
+    sync = pdb.get_sync("owner", "gh_repo")
+    assert sync.watermark == pdb.get_last_update("owner", "gh_repo")
+    assert sync.page is None
+    pdb.save_sync(sync._replace(page=3, per_page=100, target=now))
+    sync = pdb.get_sync("owner", "gh_repo")
+    assert (sync.page, sync.per_page, sync.target) == (3, 100, now)
+    assert pdb.get_sync("owner1", "gh_repo1").page is None
+
+    logging.info("Testing review windows")
+    may, june, july = [datetime.datetime(2014, m, 1) for m in (5, 6, 7)]
+    window = lib.grvtypes.ReviewWindow("owner", "gh_repo", "(lgtm)", may, june, now,
+                                       frozenset([11, 12]))
+    pdb.save_review_windows([window, window._replace(since=june, until=july,
+                                                     reviewed=frozenset())])
+    assert pdb.get_review_windows("owner", "gh_repo", "(lgtm)", may, june) == [window]
+    assert pdb.get_review_windows("owner", "gh_repo", "(sgtm)", may, july) == []
+    middle = datetime.datetime(2014, 5, 15)
+    pdb.save_review_windows([window._replace(until=middle), window._replace(since=middle)])
+    assert [w.until for w in pdb.get_review_windows("owner", "gh_repo", "(lgtm)",
+                                                    may, july)] == [middle, june, july]
+
     logging.info("Testing get_pulls_for_gh_repo")
     
     gh_repo = lib.grvtypes.Repo('owner1', 'gh_repo1', 'na', 'na')
     pulls = pdb.get_pulls_for_repo(gh_repo)
     assert len(pulls) == 1
 
-    logging.info("Dropping the table.")
+    logging.info("Testing duplicate pulls are dropped for the unique index")
     c = pdb.conn.cursor()
-    c.execute("Drop table pulls")
+    c.execute("Drop index pulls_number")
+    c.execute("INSERT INTO pulls (gh_owner, gh_repo, pull_number) VALUES (?,?,?)",
+              ("owner1", "gh_repo1", "10"))
+    c.execute("PRAGMA user_version=0")
     pdb.conn.commit()
     c.close()
+    lib.grvdb.db.close("test.db")
+    pdb = Pulls("test.db")
+    pulls = pdb.get_pulls_for_repo(gh_repo)
+    assert len(pulls) == 1
+    assert pulls[0].pull_requester is None
+
+    logging.info("Testing set_reviewers")
+    assert pdb.set_reviewers("owner", "gh_repo", [("11", "jo bob"), ("12", "jo tom")]) == 1
+    assert pdb.set_reviewers("owner", "gh_repo", [("12", None)]) == 1
+    pulls = dict((p.pull_number, p.pull_reviewer) for p in pdb.readall())
+    assert pulls["11"] == "jo bob" and pulls["12"] is None
+
+    logging.info("Removing the database.")
+    lib.grvdb.db.close("test.db")
+    os.remove("test.db")
@@ -0,0 +1,231 @@
+'''
+test with python -m lib.grvdb.reports
+'''
+
+import logging
+
+import lib.grvdb.commits
+import lib.grvdb.db
+import lib.grvdb.pulls
+from lib.grvmetrics import metrics
+
+
+# One report row per commit, with the pull it merges: the pull whose head
+# is its second parent, or else the pull whose merge sha it is.
+REPORT_ROWS = '''
+    SELECT c.id, c.label, c.sha, c.author, c.email, c.time,
+        CASE WHEN p.pull_number IS NOT NULL THEN 'pull'
+             WHEN c.ct_parents > 1 THEN 'merge' ELSE 'direct' END,
+        p.pull_number, p.pull_reviewer, COALESCE(p.pull_reviewer, '') != ''
+    FROM commits c JOIN report_labels l ON l.label = c.label
+    LEFT JOIN pulls p ON p.id = COALESCE(
+        (SELECT id FROM pulls WHERE head_sha=c.parent2 AND gh_owner=l.gh_owner
+         AND gh_repo=l.gh_repo ORDER BY id DESC LIMIT 1),
+        (SELECT id FROM pulls WHERE merge_sha=c.sha AND gh_owner=l.gh_owner
+         AND gh_repo=l.gh_repo ORDER BY id DESC LIMIT 1))
+    WHERE %s'''
+
+# The commits a pull row can be joined to, looked up on each key's index.
+PULL_COMMITS = '''c.id IN (
+        SELECT id FROM commits WHERE parent2={0}.head_sha AND label IN (
+            SELECT label FROM report_labels
+            WHERE gh_owner={0}.gh_owner AND gh_repo={0}.gh_repo)
+        UNION SELECT id FROM commits WHERE sha={0}.merge_sha AND label IN (
+            SELECT label FROM report_labels
+            WHERE gh_owner={0}.gh_owner AND gh_repo={0}.gh_repo))'''
+
+# Version 1 of the tables, see lib.grvdb.db. The triggers watch the
+# commits and pulls tables, so they come after those.
+SCHEMA = [
+    '''create table IF NOT EXISTS report_labels
+        (label text PRIMARY KEY, gh_owner text, gh_repo text)''',
+    '''create table IF NOT EXISTS reports
+        (commit_id INTEGER PRIMARY KEY, label text, sha text, author text,
+        email text, time int, type text, pr_number text, pr_reviewer text,
+        reviewed int)''',
+    '''create index IF NOT EXISTS reports_label_time
+        on reports (label, time)''',
+    '''create index IF NOT EXISTS reports_label_email
+        on reports (label, email, time)''',
+    '''create index IF NOT EXISTS reports_label_type
+        on reports (label, type, time)''',
+    '''create index IF NOT EXISTS reports_label_reviewed
+        on reports (label, reviewed, time)''',
+    # Lets a pull find its commits through either key.
+    '''create index IF NOT EXISTS commits_label_parent2
+        on commits (label, parent2)''',
+
+    '''create trigger IF NOT EXISTS reports_commit_insert
+        AFTER INSERT ON commits BEGIN
+        INSERT OR REPLACE INTO reports %s; END''' % (REPORT_ROWS % "c.id=NEW.id"),
+    '''create trigger IF NOT EXISTS reports_commit_delete
+        AFTER DELETE ON commits BEGIN
+        DELETE FROM reports WHERE commit_id=OLD.id; END''',
+    '''create trigger IF NOT EXISTS reports_pull_insert
+        AFTER INSERT ON pulls BEGIN
+        INSERT OR REPLACE INTO reports %s; END''' % (
+            REPORT_ROWS % PULL_COMMITS.format("NEW")),
+    '''create trigger IF NOT EXISTS reports_pull_update
+        AFTER UPDATE ON pulls BEGIN
+        INSERT OR REPLACE INTO reports %s;
+        INSERT OR REPLACE INTO reports %s; END''' % (
+            REPORT_ROWS % PULL_COMMITS.format("OLD"),
+            REPORT_ROWS % PULL_COMMITS.format("NEW")),
+    '''create trigger IF NOT EXISTS reports_pull_delete
+        AFTER DELETE ON pulls BEGIN
+        INSERT OR REPLACE INTO reports %s; END''' % (
+            REPORT_ROWS % PULL_COMMITS.format("OLD")),
+    ]
+
+
+class Reports(object):
+    """The commit / pull report of each tracked label, kept in a table.
+
+    Triggers on the commits and pulls tables keep the rows of tracked
+    labels current as either changes, so reading a report is an indexed
+    query that does not redo the join.
+    """
+
+    TYPES = ('direct', 'merge', 'pull')
+
+    def __init__(self, db):
+        self.commits = lib.grvdb.commits.Commits(db)
+        self.conn = lib.grvdb.db.connect(db)
+
+    def track(self, label, gh_owner, gh_repo):
+        """Keeps the report of label against the pulls of gh_owner/gh_repo.
+
+        The report is built the first time, or again if the repo changed.
+        """
+        c = self.conn.cursor()
+        c.execute("SELECT gh_owner, gh_repo FROM report_labels WHERE label=?", (label,))
+        row = c.fetchone()
+        c.close()
+        if row and (row['gh_owner'], row['gh_repo']) == (gh_owner, gh_repo):
+            return False
+        with metrics.timer("sqlite reports build"), self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO report_labels VALUES (?,?,?)",
+                              (label, gh_owner, gh_repo))
+            self.conn.execute("DELETE FROM reports WHERE label=?", (label,))
+            self.conn.execute("INSERT INTO reports %s" % (REPORT_ROWS % "c.label=?"), (label,))
+        logging.info("Built the report of %s.", label)
+        return True
+
+    def _where(self, label, since=None, until=None, email=None, type_=None,
+               reviewed=None):
+        where, params = ["r.label=?"], [label]
+        if since:
+            where.append("r.time>=?")
+            params.append(since)
+        if until:
+            where.append("r.time<?")
+            params.append(until)
+        if email:
+            where.append("r.email=?")
+            params.append(email)
+        if type_:
+            where.append("r.type=?")
+            params.append(type_)
+        if reviewed is not None:
+            where.append("r.reviewed=?")
+            params.append(1 if reviewed else 0)
+        return " AND ".join(where), params
+
+    def query(self, label, since=None, until=None, email=None, type_=None, reviewed=None):
+        """Yields the report rows of label, newest first, as sqlite Rows.
+
+        Args:
+            since, until: unix times; rows from since on and before until.
+            email: only commits by this email.
+            type_: one of TYPES.
+            reviewed: True or False to keep only reviewed or unreviewed rows.
+        """
+        where, params = self._where(label, since, until, email, type_, reviewed)
+        c = self.conn.cursor()
+        c.execute("SELECT * FROM reports r WHERE %s ORDER BY r.time DESC, r.commit_id DESC"
+                  % where, params)
+        for row in c:
+            yield row
+        c.close()
+
+    def get_commits(self, label, since=None, reviewed=None):
+        """Yields the commits of label, newest first, with their pulls.
+
+        A commit gets the pull whose head is its second parent, or else the
+        pull whose merge sha it is, as the report row holds them. since and
+        reviewed filter as in query.
+        """
+        where, params = self._where(label, since, reviewed=reviewed)
+        c = self.conn.cursor()
+        c.execute("SELECT c.*, r.pr_number AS p_number, r.pr_reviewer AS p_reviewer "
+                  "FROM reports r JOIN commits c ON c.id = r.commit_id "
+                  "WHERE %s ORDER BY c.id DESC" % where, params)
+        for row in c:
+            yield self.commits._to_type(row)._replace(pr_number=row['p_number'],
+                                                      pr_reviewer=row['p_reviewer'])
+        c.close()
+
+
+if __name__ == "__main__":
+    # All of these are unittests.
+    # TODO(jondb): Move these to unittest.
+    # run with python -m lib.grvdb.reports
+    import os
+    import lib.grvtypes
+    logging.basicConfig(level=logging.DEBUG)
+
+    logging.info("Testing reports class.")
+    rdb = Reports("test.db")
+    cdb = lib.grvdb.commits.Commits("test.db")
+    pdb = lib.grvdb.pulls.Pulls("test.db")
+
+    direct = lib.grvtypes.Commit("aaa", ("",), "test user", "test@example.com",
+                                 "1416000000", None, None, None, None, None, None)
+    merge = direct._replace(hexsha="ccc", parents=("aaa", "bbb"), time="1416000100")
+    squash = direct._replace(hexsha="ddd", parents=("ccc",), email="other@example.com",
+                             time="1416000200")
+    cdb.add_commits("label1", [direct, merge], "ccc")
+
+    logging.info("Building the report of existing commits.")
+    assert rdb.track("label1", "owner", "repo")
+    assert not rdb.track("label1", "owner", "repo")
+    rows = list(rdb.query("label1"))
+    assert [(r['sha'], r['type'], r['reviewed']) for r in rows] == [
+        ("ccc", "merge", 0), ("aaa", "direct", 0)]
+
+    logging.info("New commits and pulls update it.")
+    cdb.add_commits("label1", [squash], "ddd")
+    pdb.add_pulls([
+        lib.grvtypes.Pull("owner", "repo", "7", "requester", "xyz", "bbb", None,
+                          None, "Merged", None, None, None),
+        lib.grvtypes.Pull("owner", "other", "8", "requester", "xyz", "aaa", "reviewer",
+                          None, "Other repo", None, "aaa", None),
+        lib.grvtypes.Pull("owner", "repo", "9", "requester", "xyz", "zzz", None,
+                          None, "Squashed", None, "ddd", None)])
+    rows = list(rdb.query("label1"))
+    assert [(r['sha'], r['type'], r['pr_number']) for r in rows] == [
+        ("ddd", "pull", "9"), ("ccc", "pull", "7"), ("aaa", "direct", None)]
+    pdb.set_reviewers("owner", "repo", [("7", "reviewer")])
+    assert [r['sha'] for r in rdb.query("label1", reviewed=True)] == ["ccc"]
+    assert [r['sha'] for r in rdb.query("label1", reviewed=False)] == ["ddd", "aaa"]
+
+    logging.info("Filtering.")
+    assert [r['sha'] for r in rdb.query("label1", email="other@example.com")] == ["ddd"]
+    assert [r['sha'] for r in rdb.query("label1", type_="direct")] == ["aaa"]
+    assert [r['sha'] for r in rdb.query("label1", since=1416000050,
+                                        until=1416000150)] == ["ccc"]
+    commits = list(rdb.get_commits("label1", reviewed=False))
+    assert [(c.hexsha, c.parents, c.pr_number) for c in commits] == [
+        ("ddd", ("ccc",), "9"), ("aaa", ("",), None)]
+    commits = list(rdb.get_commits("label1"))
+    assert [(c.hexsha, c.pr_number, c.pr_reviewer) for c in commits] == [
+        ("ddd", "9", None), ("ccc", "7", "reviewer"), ("aaa", None, None)]
+    assert [c.hexsha for c in rdb.get_commits("label1", since=1416000150)] == ["ddd"]
+
+    logging.info("Clearing the label empties its report.")
+    cdb.clear("label1")
+    assert list(rdb.query("label1")) == []
+
+    logging.info("Removing the database.")
+    lib.grvdb.db.close("test.db")
+    os.remove("test.db")
@@ -1,171 +1,612 @@
 #grvgit.py
 
 """Github commands."""
+import atexit
+import itertools
 import logging
 import json
+import multiprocessing
+import sqlite3
 import subprocess
 import os
 import re
+import threading
+import time
 
 import grvtypes
+from grvmetrics import metrics
 
 
-def get_merge_commits(gitdir, branch):
+def get_merge_commits(gitdir, branch, since=None, stats=True):
     """Get merges into branch."""
-    commits = get_all_commits(gitdir, branch)
-    return [c for c in commits if len(c.parents) > 1]
+    commits = get_all_commits(gitdir, branch, since, stats)
+    return (c for c in commits if len(c.parents) > 1)
 
 
-def get_direct_commits(gitdir, branch):
+def get_direct_commits(gitdir, branch, since=None, stats=True):
     """Get commits, not merges, direct to branch."""
-    commits = get_all_commits(gitdir, branch)
-    return [c for c in commits if len(c.parents) == 1]
+    commits = get_all_commits(gitdir, branch, since, stats)
+    return (c for c in commits if len(c.parents) == 1)
 
 
-def get_all_commits(gitdir, branch):
-    """Gets all direct commits to the branch."""
-    return rev_list(gitdir, branch, '--first-parent', 'HEAD')
+def get_all_commits(gitdir, branch, since=None, stats=True):
+    """Gets all direct commits to the branch, from unix time since on."""
+    args = ['--first-parent']
+    if since:
+        args.append('--since=@%d' % since)
+    args.append(branch_ref(gitdir, branch))
+    return log_list(gitdir, *args, stats=stats)
 
 
-def rev_list(gitdir, branch, *args):
-    """Returns list of models.Commits.
+def log_list(gitdir, *args, **kwargs):
+    """Yields models.Commits with diff stats from a single `git log`.
+
+    Rather than a `git diff` per commit, the numstat for every commit is
+    read from the same stream, so the number of git processes does not
+    grow with the length of the history. Merges are diffed against their
+    first parent.
 
     Args:
-        gitdir: local dir with git.
-        branch: branch to checkout.
-        *args: additional args.
+        gitdir: local dir with git, or a bare clone.
+        *args: additional args, including the revisions to list.
+        stats: keyword, default True. If False, no diff is run and the
+            stats fields are None.
     """
-    # Select dir
-    logging.info("Changing to dir %s.", gitdir)
-    cwd = os.getcwd()
-    os.chdir(gitdir)
-    abs_git_dir = os.getcwd()
-    logging.info("CWD: %s", os.getcwd())
-    # Switch branch
-    subprocess.call(['git', 'checkout', branch, '--quiet'])
-
-    # Setup command
-    command = ['git', 'rev-list', '--full-history', '--pretty=format:%H,%P,%cn,%ce,%ct']
+    with_stats = kwargs.pop('stats', True)
+    command = ['git', 'log', LOG_FORMAT]
+    if with_stats:
+        command[2:2] = ['-m', '-w', '--numstat']
     command.extend(args)
-    res = subprocess.check_output(command)
+    return _log(command, gitdir, with_stats)
+
+
+LOG_FORMAT = '--format=%x1e%H%x1f%P%x1f%cn%x1f%ce%x1f%ct'
+def _log(command, gitdir, numstat, input=None):
+    """Yields the models.Commits of a `git log` run with LOG_FORMAT."""
+    header = None
+    ct_added, ct_removed, files = 0, 0, []
+    if not numstat:
+        ct_added, ct_removed, files = None, None, None
+    for line in _lines(command, gitdir, input):
+        if line.startswith('\x1e'):
+            if header:
+                metrics.count('git.log_commits')
+                yield _log_commit(header, ct_added, ct_removed, files)
+            header = line[1:].split('\x1f')
+            if numstat:
+                ct_added, ct_removed, files = 0, 0, []
+            continue
+        change = _numstat(line)
+        if change:
+            ct_added += change[0]
+            ct_removed += change[1]
+            files.append(change[2])
+    if header:
+        metrics.count('git.log_commits')
+        yield _log_commit(header, ct_added, ct_removed, files)
+
 
-    command = ' '.join(command)
-    logging.info(command)
+def with_stats(gitdir, commits, chunk_size=2000):
+    """Yields commits, in order, with the diff stats of those without them.
 
-    # Normalize Results
-    commits = []
-    lines = res.split("\n")
-    logging.info("Lines: %s", len(lines))
+    Stats come from the stats cache, or else from a `git log --no-walk
+    --stdin` given the shas not in it, one per chunk of chunk_size
+    commits, so the number of git processes grows as commits/chunk_size.
+    As git reads all of its input before it writes, a chunk is held until
+    it is done, and is yielded before the next one is read. Merges are
+    diffed against their first parent, as log_list does.
+    """
+    commits = iter(commits)
+    while True:
+        chunk = list(itertools.islice(commits, chunk_size))
+        if not chunk:
+            return
+        for commit in _chunk_stats(gitdir, chunk):
+            yield commit
 
-    for l in lines:
-        # Some reason rev-list ignores format and always prints
-        # a commit <sha> preceding the formatted line.
-        if l.strip() == "" or l.startswith("commit"):
+
+def _chunk_stats(gitdir, commits):
+    found, missing = {}, []
+    for commit in commits:
+        if commit.ct_added is not None or commit.hexsha in found:
             continue
-        try:
-            sha, parents_string, author, email, t = l.split(',')
-            parents = tuple(parents_string.split(' '))
-        except ValueError as e:
-            print e
-            print "'%s'" % l
-            exit()
-        ct_added, ct_removed, ct_files, files = stats(abs_git_dir, branch, sha, parents[0], False)
-        commits.append(grvtypes.Commit(
-            sha,
-            parents,
-            author,
-            email,
-            t,
-            ct_added,
-            ct_removed,
-            ct_files,
-            files,
-            None,
-            None
-            ))
-
-    # Return results
-    os.chdir(cwd)
-    return commits
+        res = gcache.cache_get(commit.hexsha)
+        if res:
+            metrics.count('stats_cache.hit')
+            found[commit.hexsha] = res
+        else:
+            metrics.count('stats_cache.miss')
+            found[commit.hexsha] = None
+            missing.append(commit.hexsha)
+    if missing:
+        command = ['git', 'log', '--no-walk=unsorted', '--stdin', '-m', '--first-parent',
+                   '-w', '--numstat', LOG_FORMAT]
+        for commit in _log(command, gitdir, True, missing):
+            res = (commit.ct_added, commit.ct_removed, commit.ct_files, commit.files)
+            found[commit.hexsha] = res
+            gcache.cache_put(commit.hexsha, res)
+
+    for commit in commits:
+        if commit.ct_added is None:
+            ct_added, ct_removed, ct_files, files = found[commit.hexsha]
+            commit = commit._replace(ct_added=ct_added, ct_removed=ct_removed,
+                                     ct_files=ct_files, files=files)
+        yield commit
+
+
+def log_list_sharded(gitdir, rev_range, jobs, stats=True, min_shard=5000):
+    """Yields what log_list(gitdir, '--first-parent', '--reverse', rev_range)
+    does, with the history read in shards by a pool of jobs processes.
+
+    The first-parent history is cut into contiguous ranges of at least
+    min_shard commits, each read by its own `git log` in a worker, and
+    the shards are yielded back in order. Workers send their commits as a
+    CommitStore. In a pool worker, which cannot have children, or with
+    jobs below 2, it is log_list.
+
+    Args:
+        rev_range: a sha, or "last..head" as for an incremental scan.
+    """
+    args = ('--first-parent', '--reverse', rev_range)
+    if jobs < 2 or multiprocessing.current_process().daemon:
+        return log_list(gitdir, *args, stats=stats)
+    command = ['git', 'rev-list', '--count', '--first-parent', rev_range]
+    with _git_timer(command):
+        count = int(subprocess.check_output(command, cwd=gitdir))
+    size = max(min_shard, -(-count // (jobs * 4)))
+    if count <= size:
+        return log_list(gitdir, *args, stats=stats)
+    return _log_shards(gitdir, rev_range, jobs, stats, size)
+
+
+def _log_shards(gitdir, rev_range, jobs, stats, size):
+    # The last commit of each shard is the base of the next one.
+    base, _, head = rev_range.rpartition('..')
+    ends = []
+    command = ['git', 'rev-list', '--first-parent', '--reverse', rev_range]
+    for i, sha in enumerate(_lines(command, gitdir), 1):
+        if i % size == 0:
+            ends.append(sha)
+    if not ends or ends[-1] != head:
+        ends.append(head)
+    tasks = []
+    for end in ends:
+        tasks.append((gitdir, '%s..%s' % (base, end) if base else end, stats))
+        base = end
+    logging.info("Reading %s in %s shards.", rev_range, len(tasks))
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for store, files, summary in pool.imap(_log_shard, tasks):
+            metrics.merge(summary)
+            for i, commit in enumerate(store):
+                yield commit._replace(files=files[i]) if stats else commit
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _log_shard(task):
+    """Pool worker: reads one shard of log_list_sharded."""
+    gitdir, rev_range, stats = task
+    metrics.reset()
+    store, files = grvtypes.CommitStore(), []
+    for commit in log_list(gitdir, '--first-parent', '--reverse', rev_range, stats=stats):
+        store.append(commit)
+        files.append(commit.files)
+    return store, files, metrics.summary()
+
+
+def _lines(command, gitdir, input=None):
+    """Yields the lines of a git command's output as they are written.
+
+    Only a line at a time is held, however long the output. The process is
+    counted and timed as _git_timer does, for as long as the stream is
+    open, including the caller's work on it. A failed command raises
+    CalledProcessError at the end; a caller that stops early has it killed.
+
+    If input is set, its items are written to the command's stdin a line
+    each before any output is read, for commands like `git log --stdin`
+    that read all of their input first.
+    """
+    logging.info(' '.join(command))
+    metrics.count('git.processes')
+    start = time.time()
+    proc = subprocess.Popen(command, cwd=gitdir, stdout=subprocess.PIPE,
+                            stdin=subprocess.PIPE if input is not None else None)
+    done = False
+    try:
+        if input is not None:
+            for item in input:
+                proc.stdin.write('%s\n' % item)
+            proc.stdin.close()
+        for line in iter(proc.stdout.readline, ''):
+            yield line.rstrip('\n')
+        done = True
+    finally:
+        if not done and proc.poll() is None:
+            # Nobody reads the rest.
+            try:
+                proc.kill()
+            except OSError:
+                pass
+        proc.stdout.close()
+        returncode = proc.wait()
+        metrics.record(' '.join(command[:2]), time.time() - start)
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, ' '.join(command))
+
+
+def _numstat(line):
+    """Parses a --numstat line to (added, removed, file), or None.
+
+    Blank lines are None, and so are lines that do not parse, which are
+    logged and counted rather than failing the run.
+    """
+    if not line:
+        return None
+    mres = re_change_count.match(line)
+    if not mres:
+        logging.warning("Unparsed numstat line: '%s'", line)
+        metrics.count('git.unparsed_lines')
+        return None
+    # Binary files +1.
+    return (int(mres.group(1) if mres.group(1) else 1),
+            int(mres.group(2) if mres.group(2) else 0),
+            mres.group(3))
+
+
+def _log_commit(header, ct_added, ct_removed, files):
+    """Builds a models.Commit from a `git log` header and its numstat."""
+    sha, parents_string, author, email, t = header
+    return grvtypes.Commit(
+        sha,
+        tuple(parents_string.split(' ')),
+        author,
+        email,
+        t,
+        ct_added,
+        ct_removed,
+        len(files) if files is not None else None,
+        files,
+        None,
+        None
+        )
 
 
 def update(gitdir, branch):
-    """Updates the branch and returns the last commit (HEAD)."""
-    cwd = os.getcwd()
-    os.chdir(gitdir)
-    subprocess.call(['git', 'checkout', branch, '--quiet'])
-    subprocess.call(['git', 'pull', '--quiet'])
-    os.chdir(cwd)
-    return rev_list(gitdir, branch, 'HEAD')[0].hexsha
+    """Fetches the branch and returns its last commit.
+
+    Only refs are updated; the worktree, if there is one, is left alone.
+    """
+    command = ['git', 'fetch', '--quiet', '--prune']
+    with _git_timer(command):
+        subprocess.call(command, cwd=gitdir)
+    return head(gitdir, branch)
+
+
+def branch_ref(gitdir, branch):
+    """Returns the ref to read branch history from.
+
+    That is the branch's upstream (e.g. refs/remotes/origin/master) when
+    it has one, so a fetch is enough to see new commits. Otherwise it is
+    the branch itself, as in a bare mirror clone, or failing that its
+    remote tracking ref, as in a clone that never checked it out.
+
+    Raises:
+        ValueError: the branch is neither local nor on origin.
+    """
+    command = ['git', 'rev-parse', '--verify', '--quiet', '--symbolic-full-name',
+               '%s@{upstream}' % branch]
+    with open(os.devnull, 'w') as devnull, _git_timer(command):
+        proc = subprocess.Popen(command, cwd=gitdir, stdout=subprocess.PIPE, stderr=devnull)
+        upstream = proc.communicate()[0].strip()
+    if proc.returncode == 0 and upstream:
+        return upstream
+
+    candidates = ['refs/heads/%s' % branch, 'refs/remotes/origin/%s' % branch]
+    command = ['git', 'for-each-ref', '--format=%(refname)'] + candidates
+    with _git_timer(command):
+        # A pattern also matches the refs below it, so keep exact names only.
+        refs = set(subprocess.check_output(command, cwd=gitdir).split())
+    for ref in candidates:
+        if ref in refs:
+            return ref
+    raise ValueError("Branch %s is not in %s, as %s." % (
+        branch, gitdir, ' or '.join(candidates)))
+
+
+def head(gitdir, branch):
+    """Returns the sha branch points at."""
+    command = ['git', 'rev-parse', '--verify', '%s^{commit}' % branch_ref(gitdir, branch)]
+    with _git_timer(command):
+        return subprocess.check_output(command, cwd=gitdir).strip()
+
+
+def is_ancestor(gitdir, ancestor, sha):
+    """True if ancestor is reachable from sha, False if not or unknown."""
+    command = ['git', 'merge-base', '--is-ancestor', ancestor, sha]
+    with open(os.devnull, 'w') as devnull, _git_timer(command):
+        return subprocess.call(command, cwd=gitdir, stderr=devnull) == 0
+
+
+def _git_timer(command):
+    """Counts a git process and times it as a call of its subcommand."""
+    metrics.count('git.processes')
+    return metrics.timer(' '.join(command[:2]))
+
+
+re_person = re.compile(r'^(.*) <(.*)> (\d+) [+-]\d{4}$')
+class GitObjects(object):
+    """Looks up objects through long-lived `git cat-file --batch` processes.
+
+    Each lookup is a write and a read on a pipe rather than a fork, and
+    lists of shas are pipelined. Safe to share between threads. Refs are
+    not resolved here, as a running cat-file may not see ref updates.
+    """
+
+    def __init__(self, gitdir):
+        self.gitdir = gitdir
+        self.lock = threading.Lock()
+        self.batch = None
+        self.batch_check = None
+
+    def _start(self, option):
+        metrics.count('git.processes')
+        return subprocess.Popen(['git', 'cat-file', option], cwd=self.gitdir, bufsize=-1,
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def _request(self, proc, shas, read):
+        """Writes shas to proc from a thread while read() takes each reply."""
+        def write():
+            for sha in shas:
+                proc.stdin.write('%s\n' % sha)
+            proc.stdin.flush()
+        metrics.count('git.cat_file_objects', len(shas))
+        with metrics.timer('git cat-file request'):
+            if len(shas) == 1:
+                write()
+                return [read(proc)]
+            writer = threading.Thread(target=write)
+            writer.start()
+            res = [read(proc) for _ in shas]
+            writer.join()
+            return res
+
+    def _read_check(self, proc):
+        fields = proc.stdout.readline().split()
+        if len(fields) != 3:
+            return None
+        return fields[1]
+
+    def _read_object(self, proc):
+        fields = proc.stdout.readline().split()
+        if len(fields) != 3:
+            return None
+        sha, type_, size = fields
+        body = proc.stdout.read(int(size) + 1)[:-1]
+        return sha, type_, body
+
+    def types(self, shas):
+        """Returns the type of each sha, or None for missing objects."""
+        with self.lock:
+            if not self.batch_check:
+                self.batch_check = self._start('--batch-check')
+            return self._request(self.batch_check, list(shas), self._read_check)
+
+    def commits(self, shas):
+        """Returns a models.Commit without diff stats for each sha.
+
+        Missing objects and objects that are not commits give None.
+        """
+        with self.lock:
+            if not self.batch:
+                self.batch = self._start('--batch')
+            objs = self._request(self.batch, list(shas), self._read_object)
+        return [_parse_commit(obj[0], obj[2]) if obj and obj[1] == 'commit' else None
+                for obj in objs]
+
+    def commit(self, sha):
+        return self.commits([sha])[0]
+
+    def close(self):
+        with self.lock:
+            for proc in (self.batch, self.batch_check):
+                if proc:
+                    proc.stdin.close()
+                    proc.wait()
+            self.batch, self.batch_check = None, None
+
+
+def _parse_commit(sha, body):
+    """Builds a models.Commit from the headers of a raw commit object."""
+    parents = []
+    author, email, t = None, None, None
+    for line in body.split('\n'):
+        if not line:
+            break
+        if line.startswith('parent '):
+            parents.append(line[7:])
+        elif line.startswith('committer '):
+            mres = re_person.match(line[10:])
+            if mres:
+                author, email, t = mres.groups()
+    return grvtypes.Commit(
+        sha,
+        tuple(parents) or ('',),
+        author,
+        email,
+        t,
+        None,
+        None,
+        None,
+        None,
+        None,
+        None
+        )
 
 
 class GCache(object):
-    def __init__(self):
-        self.loaded = 0
-        self.c = None
+    """Diff stat cache keyed by sha, kept in a sqlite file.
+
+    Lookups go to the primary key index instead of a dict holding every
+    entry, and puts are buffered and written `batch_size` at a time in one
+    transaction. WAL journaling lets concurrent runs share the file.
+    """
+
+    def __init__(self, path=".grvcache.db", batch_size=500):
+        self.path = os.path.abspath(path)
+        self.batch_size = batch_size
+        self.conn = None
+        self.pending = {}
+        self.lock = threading.Lock()
 
     def cache_load(self):
-        if not os.path.exists(".grvcache"):
-            with open(".grvcache", 'w') as cf:
-                json.dump({}, cf)
-        with open(".grvcache", 'r') as cf:
-            c = json.load(cf)
-            self.c = c
-        self.loaded = 1
+        self.conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute('''create table IF NOT EXISTS stats
+            (sha text PRIMARY KEY, ct_added int, ct_removed int,
+            ct_files int, files text)''')
+        self.conn.commit()
 
     def cache_get(self, id_):
-        if not self.loaded:
-            self.cache_load()
-        if id_ in self.c:
-            return self.c[id_]
-        else:
-            return None
+        with self.lock:
+            if id_ in self.pending:
+                return self.pending[id_]
+            if not self.conn:
+                self.cache_load()
+            row = self.conn.execute(
+                "SELECT ct_added, ct_removed, ct_files, files FROM stats WHERE sha=?",
+                (id_,)).fetchone()
+        if row:
+            return (row[0], row[1], row[2], json.loads(row[3]))
+        return None
 
     def cache_put(self, id_, val):
-        self.c[id_] = val
-        self.cache_save()
+        with self.lock:
+            self.pending[id_] = val
+            full = len(self.pending) >= self.batch_size
+        if full:
+            self.cache_save()
 
     def cache_save(self):
-        with open(".grvcache", 'w') as cf:
-            json.dump(self.c, cf)
+        with self.lock:
+            if not self.pending:
+                return
+            if not self.conn:
+                self.cache_load()
+            rows = [(k, v[0], v[1], v[2], json.dumps(v[3]))
+                    for k, v in self.pending.iteritems()]
+            with metrics.timer('stats_cache save'), self.conn:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO stats VALUES (?,?,?,?,?)", rows)
+            metrics.count('stats_cache.rows_written', len(rows))
+            self.pending = {}
 
 
 gcache = GCache()
+atexit.register(gcache.cache_save)
 re_change_count = re.compile(r'([\d]*)-?\s+(\d*)-?\s+(.*)')
-def stats(gitdir, branch, parent, head, checkout=True):
-    """Updates the branch and returns the last commit (HEAD)."""
-    cwd = os.getcwd()
+
+
+if __name__ == "__main__":
+    # run with python lib/grvgit.py
+    import shutil
+    import tempfile
+    logging.basicConfig(level=logging.DEBUG)
+
+    logging.info("Making a small repo.")
+    gitdir = tempfile.mkdtemp()
+    env = dict(os.environ, GIT_AUTHOR_NAME="test user", GIT_AUTHOR_EMAIL="test@example.com",
+               GIT_COMMITTER_NAME="test user", GIT_COMMITTER_EMAIL="test@example.com",
+               GIT_COMMITTER_DATE="1416000000 +0000")
+    def git(*args):
+        return subprocess.check_output(('git',) + args, cwd=gitdir, env=env).strip()
+    git('init', '--quiet')
+    with open(os.path.join(gitdir, 'a.txt'), 'w') as f:
+        f.write('a\n')
+    git('add', 'a.txt')
+    git('commit', '--quiet', '-m', 'first')
+    git('commit', '--quiet', '--allow-empty', '-m', 'second')
+    first, second = git('rev-parse', 'HEAD~1'), git('rev-parse', 'HEAD')
+    blob = git('rev-parse', 'HEAD:a.txt')
+    missing = '0' * 40
+
+    logging.info("Looking up types.")
+    objs = GitObjects(gitdir)
+    assert objs.types([second, blob, missing, first]) == ['commit', 'blob', None, 'commit']
+
+    logging.info("Reading commits.")
+    commits = objs.commits([first, missing, second, blob])
+    assert commits[1] is None and commits[3] is None
+    assert commits[0].hexsha == first and commits[0].parents == ('',)
+    assert commits[2].parents == (first,)
+    assert (commits[2].author, commits[2].email, commits[2].time) == (
+        "test user", "test@example.com", "1416000000")
+    assert objs.commit(missing) is None
+    assert objs.commit(second) == commits[2]
+    objs.close()
+
+    logging.info("Finding the ref of a branch.")
+    assert branch_ref(gitdir, 'master') == 'refs/heads/master'
+    git('update-ref', 'refs/remotes/origin/remote-only', first)
+    assert branch_ref(gitdir, 'remote-only') == 'refs/remotes/origin/remote-only'
+    assert head(gitdir, 'remote-only') == first
+    git('config', 'remote.origin.url', gitdir)
+    git('config', 'remote.origin.fetch', '+refs/heads/*:refs/remotes/origin/*')
+    git('config', 'branch.master.remote', 'origin')
+    git('config', 'branch.master.merge', 'refs/heads/remote-only')
+    assert branch_ref(gitdir, 'master') == 'refs/remotes/origin/remote-only'
+    git('config', '--remove-section', 'branch.master')
     try:
-        os.chdir(gitdir)
-    except OSError:
-        print "CWD: %s" % cwd
-        raise
-
-    cache_key = head
-    res = gcache.cache_get(cache_key)
-
-    if not res:
-        ct_added, ct_removed, files = 0, 0, []
-        #git diff -w --numstat d860f200f73b248b59d33e7e4cd2d79a86b9f348..4d09275d4535d7c1f5657f6a0cfb9f121ed90485
-        if checkout:
-            subprocess.call(['git', 'checkout', branch, '--quiet'])
-        res = subprocess.check_output(['git', 'diff', '-w', '--numstat', '%s..%s' % (parent, head)])
-        if res:
-            for line in res.split("\n"):
-                if not line:
-                    continue
-                mres = re_change_count.match(line)
-                if not mres:
-                    print "Failed", line
-                    exit(1)
-                # Binary files +1.
-                added, removed, file_ = mres.groups()
-                ct_added += int(mres.group(1) if mres.group(1) else 1)
-                ct_removed += int(mres.group(2) if mres.group(2) else 0)
-                files.append(mres.group(3))
-        res = (ct_added, ct_removed, len(files), files)
-        gcache.cache_put(cache_key, res)
-
-    os.chdir(cwd)
-    return res
+        branch_ref(gitdir, 'missing')
+        assert False, "a missing branch has no ref"
+    except ValueError as e:
+        assert 'refs/remotes/origin/missing' in str(e), e
+
+    logging.info("Filling in stats from one git process.")
+    gcache = GCache(os.path.join(gitdir, 'cache.db'))
+    def commit_file(name, text):
+        with open(os.path.join(gitdir, name), 'w') as f:
+            f.write(text)
+        git('add', name)
+        git('commit', '--quiet', '-m', name)
+    git('checkout', '--quiet', '-b', 'topic')
+    commit_file('b.txt', 'b\nb\n')
+    git('checkout', '--quiet', '-')
+    commit_file('c.txt', 'c\n')
+    git('merge', '--quiet', '--no-ff', '-m', 'merge', 'topic')
+    processes, lines = [], ['a']
+    for n in (4, 12):
+        while len(list(log_list(gitdir, '--first-parent', 'HEAD', stats=False))) < n:
+            lines.append('line %s' % len(lines))
+            commit_file('a.txt', '\n'.join(lines) + '\n')
+        expected = list(log_list(gitdir, '--first-parent', 'HEAD'))
+        before = metrics.summary()['counters']['git.processes']
+        filled = list(with_stats(gitdir, log_list(gitdir, '--first-parent', 'HEAD',
+                                                  stats=False)))
+        processes.append(metrics.summary()['counters']['git.processes'] - before)
+        assert filled == expected, (filled, expected)
+    merge = [c for c in filled if len(c.parents) == 2][0]
+    assert (merge.ct_added, merge.ct_removed, merge.ct_files, merge.files) == (
+        2, 0, 1, ['b.txt'])
+    assert filled[-1].files == ['a.txt']
+    assert processes == [2, 2], processes
+
+    logging.info("Cached stats start no git log.")
+    before = metrics.summary()['counters']['git.processes']
+    assert list(with_stats(gitdir, log_list(gitdir, '--first-parent', 'HEAD',
+                                            stats=False))) == expected
+    assert metrics.summary()['counters']['git.processes'] - before == 1
+
+    logging.info("Stats are read a chunk at a time.")
+    gcache = GCache(os.path.join(gitdir, 'chunks.db'))
+    before = metrics.summary()['counters']['git.processes']
+    chunked = with_stats(gitdir, log_list(gitdir, '--first-parent', 'HEAD', stats=False),
+                         chunk_size=5)
+    assert next(chunked) == expected[0]
+    assert metrics.summary()['counters']['git.processes'] - before == 2
+    assert [expected[0]] + list(chunked) == expected
+    assert metrics.summary()['counters']['git.processes'] - before == 4
 
+    shutil.rmtree(gitdir)
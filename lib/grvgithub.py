@@ -2,78 +2,607 @@
 
 Wraps PyGithub
 '''
+import collections
+import datetime
+import httplib
+import itertools
+import json
 import logging
+import os
+import Queue
 import re
+import sqlite3
+import sys
+import threading
+import time
+# strptime imports this on first use, which fails when threads parsing
+# PyGithub timestamps race to it (Python issue 7980).
+import _strptime
 
 from github import Github as pyGithub
+import github.IssueComment
+import github.PaginatedList
+import github.Requester
 import lib.grvtypes
+from lib.grvmetrics import metrics
 
 
 re_review = re.compile(r'lgtm|sgtm|looks good to me|sounds good to me')
+review_phrases = ("lgtm", "sgtm", "looks good to me", "sounds good to me")
 
+# The search API gives at most this many results of a query.
+SEARCH_CAP = 1000
+# A window is not split below this, even if it holds more.
+SEARCH_MIN_WINDOW = datetime.timedelta(hours=1)
+# New comments can take this long to be found by search.
+SEARCH_LAG = datetime.timedelta(minutes=10)
+
+
+def review_pattern(phrases=None):
+    """Returns the regex matching any of phrases, or re_review if none."""
+    if not phrases:
+        return re_review
+    return re.compile('|'.join(re.escape(p.lower()) for p in phrases))
+
+
+def review_query(phrases=None):
+    """Returns the search terms for comments with any of phrases.
+
+    Search matches whole words, not the substrings review_pattern does,
+    so it is used to pick which pulls to read comments of, not to decide.
+    """
+    return "(%s)" % " OR ".join('"%s"' % p.lower() for p in phrases or review_phrases)
+
+
+def _search_time(value):
+    return value.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def find_reviewer(requester, comments, pattern=re_review):
+    """Returns the login of the first non-requester approving the pull.
+
+    Args:
+        requester: login of who opened the pull.
+        comments: lib.grvtypes.IssueComments of the pull, oldest first.
+        pattern: regex of the approving phrases, matched in lower case.
+    """
+    for comment in comments:
+        # Ignore if the commenter is the requester.
+        if comment.gh_user == requester:
+            continue
+
+        # Search for magic review words.
+        if pattern.search(comment.body.lower()):
+            return comment.gh_user
+    return None
+
+
+class _Task(object):
+    """A call run by a worker thread, waited on by the caller."""
+
+    def __init__(self, func, item):
+        self.func = func
+        self.item = item
+        self.done = threading.Event()
+        self.value = None
+        self.exc_info = None
+
+    def run(self):
+        try:
+            self.value = self.func(self.item)
+        except Exception:
+            self.exc_info = sys.exc_info()
+        self.done.set()
+
+    def result(self):
+        self.done.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+
+def _ordered_map(func, items, workers):
+    """Yields (item, func(item)) in the order of items.
+
+    Up to `workers` calls run at once in threads. items is consumed lazily
+    and at most 2 * workers calls are queued ahead of the one being
+    yielded, so a paginated items keeps paging while calls are in flight.
+    """
+    if workers <= 1:
+        for item in items:
+            yield item, func(item)
+        return
+
+    tasks = Queue.Queue()
+
+    def work():
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            task.run()
+
+    threads = [threading.Thread(target=work) for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    pending = collections.deque()
+    try:
+        for item in items:
+            task = _Task(func, item)
+            pending.append(task)
+            tasks.put(task)
+            if len(pending) >= 2 * workers:
+                task = pending.popleft()
+                yield task.item, task.result()
+        while pending:
+            task = pending.popleft()
+            yield task.item, task.result()
+    finally:
+        # Drop calls nobody will wait for if the caller stopped early.
+        while True:
+            try:
+                tasks.get_nowait()
+            except Queue.Empty:
+                break
+        for _ in threads:
+            tasks.put(None)
+        for thread in threads:
+            thread.join()
+
+
+class ResponseCache(object):
+    """GET responses with their ETag / Last-Modified, kept in a sqlite file.
+
+    Entries past max_bytes are evicted least recently used first.
+    """
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024):
+        self.path = os.path.abspath(path)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute('''create table IF NOT EXISTS responses
+            (url text PRIMARY KEY, etag text, last_modified text,
+            headers text, body text, size int, atime real)''')
+        self.conn.execute('''create index IF NOT EXISTS responses_atime
+            on responses (atime)''')
+        self.conn.commit()
+        self.size = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, url):
+        """Returns (etag, last_modified, headers, body) for url, or None."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT etag, last_modified, headers, body FROM responses WHERE url=?",
+                (url,)).fetchone()
+        if row:
+            return row[0], row[1], json.loads(row[2]), row[3]
+        return None
+
+    def hit(self, url):
+        metrics.count("http_cache.hit")
+        with self.lock:
+            self.hits += 1
+            with self.conn:
+                self.conn.execute("UPDATE responses SET atime=? WHERE url=?",
+                                  (time.time(), url))
+
+    def miss(self):
+        metrics.count("http_cache.miss")
+        with self.lock:
+            self.misses += 1
+
+    def put(self, url, etag, last_modified, headers, body):
+        size = len(body)
+        with self.lock:
+            with self.conn:
+                old = self.conn.execute("SELECT size FROM responses WHERE url=?",
+                                        (url,)).fetchone()
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?,?,?,?,?,?,?)",
+                    (url, etag, last_modified, json.dumps(headers), body, size,
+                     time.time()))
+                self.size += size - (old[0] if old else 0)
+                if self.size > self.max_bytes:
+                    self._evict()
+
+    def _evict(self):
+        """Drops the oldest entries until the cache is 90% of max_bytes."""
+        c = self.conn.execute("SELECT url, size FROM responses ORDER BY atime")
+        evict = []
+        for url, size in c:
+            if self.size <= self.max_bytes * 0.9:
+                break
+            evict.append((url,))
+            self.size -= size
+        c.close()
+        self.conn.executemany("DELETE FROM responses WHERE url=?", evict)
+        logging.info("HTTP cache evicted %s responses.", len(evict))
+
+    def log_stats(self):
+        logging.info("HTTP cache hits: %s, misses: %s, size: %s bytes",
+                     self.hits, self.misses, self.size)
+
+
+class TokenPool(object):
+    """GitHub tokens, with the rate limit each has left as the response
+    headers tell.
+
+    Each request is sent with the token that has the most requests left
+    of its resource (core or search). Tokens not heard of yet come first.
+    When every token is out, take waits for the first reset instead of
+    letting the request fail.
+    """
+
+    def __init__(self, tokens):
+        self.tokens = list(tokens)
+        self.lock = threading.Lock()
+        # (token, resource) -> [remaining, reset as unix time]
+        self.limits = {}
+        self.waiting_for = None
+
+    def take(self, resource):
+        """Returns the token to send a request of resource with."""
+        while True:
+            with self.lock:
+                now = time.time()
+                best, best_left, first_reset = None, -1, None
+                for token in self.tokens:
+                    limit = self.limits.get((token, resource))
+                    left = float("inf")
+                    if limit and limit[1] > now:
+                        left = limit[0]
+                    if left > best_left:
+                        best, best_left = token, left
+                    if left <= 0:
+                        first_reset = min(first_reset or limit[1], limit[1])
+                if best_left > 0:
+                    if best_left != float("inf"):
+                        # Counted now so that concurrent requests spread out
+                        # before their headers come back.
+                        self.limits[(best, resource)][0] -= 1
+                    return best
+                wait = first_reset - now + 1
+                warn, self.waiting_for = self.waiting_for != first_reset, first_reset
+            if warn:
+                logging.warning("All %s tokens are out of %s requests, waiting %ds.",
+                                len(self.tokens), resource, wait)
+            metrics.count("github.rate_limit_waits")
+            with metrics.timer("github rate limit wait"):
+                time.sleep(wait)
+
+    def update(self, token, resource, status, headers):
+        """Notes the rate limit headers of a response sent with token.
+
+        Returns True if the request was refused for the rate limit, and
+        should be sent again.
+        """
+        if "x-ratelimit-remaining" not in headers:
+            return False
+        resource = headers.get("x-ratelimit-resource", resource)
+        remaining = int(headers["x-ratelimit-remaining"])
+        reset = int(headers.get("x-ratelimit-reset", 0))
+        limited = status in (403, 429) and (remaining == 0 or "retry-after" in headers)
+        if limited and "retry-after" in headers:
+            # A secondary rate limit says how long to wait instead.
+            remaining, reset = 0, time.time() + int(headers["retry-after"])
+        with self.lock:
+            limit = self.limits.get((token, resource))
+            if limit and limit[1] == reset:
+                # Responses of concurrent requests come back in any order.
+                remaining = min(remaining, limit[0])
+            self.limits[(token, resource)] = [remaining, reset]
+        if limited:
+            metrics.count("github.rate_limited")
+        return limited
+
+
+class _CachedResponse(object):
+    """Mimics the httplib response PyGithub reads."""
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def getheaders(self):
+        return self.headers.items()
+
+    def read(self):
+        return self.body
+
+
+class _Connection(object):
+    """Mimics the httplib connection PyGithub drives.
+
+    The underlying connection is kept per thread, as PyGithub would share a
+    single one between the comment workers. When a ResponseCache is set,
+    GETs are sent with If-None-Match / If-Modified-Since and a 304, which
+    does not count against the rate limit, is answered from the cache.
+    When a TokenPool is set, each request is sent with the token it picks,
+    and sent again if refused for the rate limit.
+    """
+    base = None
+    cache = None
+    tokens = None
+    local = threading.local()
+
+    def __init__(self, host, port=None, **kwds):
+        key = (self.base, host, port)
+        connections = self.local.__dict__.setdefault("connections", {})
+        if key not in connections:
+            connections[key] = self.base(host, port, **kwds)
+        self.cnx = connections[key]
+        self.key = None
+        self.cached = None
+        self.kind = None
+        self.start = None
+        self.sent = None
+        self.token = None
+
+    def request(self, verb, url, input, headers):
+        self.kind = _request_kind(url)
+        self.start = time.time()
+        if self.cache and verb == "GET":
+            self.key = "%s:%s%s" % (self.cnx.host, self.cnx.port, url)
+            self.cached = self.cache.get(self.key)
+            if self.cached:
+                etag, last_modified = self.cached[0], self.cached[1]
+                headers = dict(headers)
+                if etag:
+                    headers["If-None-Match"] = etag
+                if last_modified:
+                    headers["If-Modified-Since"] = last_modified
+        self.sent = (verb, url, input, headers)
+        self._send()
+
+    def _send(self):
+        verb, url, input, headers = self.sent
+        if self.tokens:
+            self.token = self.tokens.take("search" if self.kind == "search" else "core")
+            headers = dict(headers, Authorization="token %s" % self.token)
+        self.cnx.request(verb, url, input, headers)
+
+    def getresponse(self):
+        while True:
+            response = self.cnx.getresponse()
+            metrics.record("github %s" % self.kind, time.time() - self.start)
+            metrics.count("github.requests")
+            metrics.count("github.requests.%s" % self.kind)
+            headers = dict((k.lower(), v) for k, v in response.getheaders())
+            if "x-ratelimit-remaining" in headers:
+                metrics.gauge("github.rate_limit_remaining",
+                              int(headers["x-ratelimit-remaining"]))
+            if not (self.tokens and self.tokens.update(
+                    self.token, "search" if self.kind == "search" else "core",
+                    response.status, headers)):
+                break
+            response.read()
+            self.start = time.time()
+            self._send()
+
+        if not self.key:
+            return response
+
+        if response.status == 304 and self.cached:
+            self.cache.hit(self.key)
+            # Keep the fresh rate limit headers over the stored ones.
+            cached_headers = self.cached[2]
+            cached_headers.update(headers)
+            return _CachedResponse(200, cached_headers, self.cached[3])
+
+        self.cache.miss()
+        body = response.read()
+        if response.status == 200 and ("etag" in headers or "last-modified" in headers):
+            self.cache.put(self.key, headers.get("etag"), headers.get("last-modified"),
+                           headers, body)
+        return _CachedResponse(response.status, headers, body)
+
+    def close(self):
+        self.cnx.close()
+
+
+def _request_kind(url):
+    """Names the API call of url for metrics, e.g. "pulls" or "comments"."""
+    path = url.split("?")[0].rstrip("/").split("/")
+    if "search" in path:
+        return "search"
+    for kind in ("comments", "pulls", "issues"):
+        if kind in path[-2:]:
+            return kind
+    return "other"
+
+
+class _HTTPConnection(_Connection):
+    base = getattr(github.Requester, "HTTPRequestsConnectionClass", httplib.HTTPConnection)
+
+
+class _HTTPSConnection(_Connection):
+    base = getattr(github.Requester, "HTTPSRequestsConnectionClass", httplib.HTTPSConnection)
+
+
+_inject_lock = threading.Lock()
 class GRVGithub(pyGithub):
 
-    def get_pulls(self, gh_owner, gh_repo, last_update_time=None, skip_pulls=None, use_search=False):
-        repo = self.get_user(gh_owner).get_repo(gh_repo)
-        pulls = []
-        logging.info("Getting the comments.")
-
-        if use_search:
-            reviewed = []
-            issue_query = 'repo:%s/%s type:pr in:comment is:closed (LGTM OR SGTM OR "looks good to me" OR "sounds good to me")' % (gh_owner, gh_repo)
-            logging.info("Query: %s", issue_query)
-            for issue in self.search_issues(issue_query):
-                reviewed.append(issue.number)
-
-        logging.info("Getting the pulls.")
-        for pull in repo.get_pulls(state="closed", sort="updated", direction="desc"):
-            if not pull.merged:
-                continue
-            
-            updated = pull.updated_at
-            logging.info("Pull %s updated at %s", pull.number, pull.updated_at)
-            
-            if last_update_time and updated < last_update_time:
-                logging.warning("We've found the last pull. %s, %s, %s",
-                        pull.number, updated, last_update_time)
+    def __init__(self, *args, **kwargs):
+        """Takes PyGithub's arguments, plus comment_workers, page_workers,
+        http_cache and tokens.
+
+        comment_workers is the number of pulls whose comments are fetched
+        at once, and page_workers the number of pages of pulls a backfill
+        reads at once. http_cache is the path of a ResponseCache file, capped at
+        http_cache_mb megabytes. per_page defaults to 100, the most the API
+        allows, rather than 30. tokens are more tokens to spread requests
+        over, see TokenPool; the token GRVGithub is made with is used alone
+        if there are none.
+        """
+        kwargs.setdefault("per_page", 100)
+        self.comment_workers = kwargs.pop("comment_workers", 8)
+        self.page_workers = kwargs.pop("page_workers", 4)
+        http_cache = kwargs.pop("http_cache", None)
+        http_cache_mb = kwargs.pop("http_cache_mb", 256)
+        tokens = kwargs.pop("tokens", None) or args[:1]
+
+        self.http_cache = None
+        if http_cache:
+            self.http_cache = ResponseCache(http_cache, http_cache_mb * 1024 * 1024)
+        self.tokens = TokenPool(tokens) if any(tokens) else None
+
+        # PyGithub only takes connection classes process wide, and a
+        # Requester keeps the one set when it is made. Each client gets
+        # classes bound to its own cache and tokens, set just for that.
+        attrs = {"cache": self.http_cache, "tokens": self.tokens}
+        with _inject_lock:
+            github.Requester.Requester.injectConnectionClasses(
+                type("_HTTPConnection", (_HTTPConnection,), attrs),
+                type("_HTTPSConnection", (_HTTPSConnection,), attrs))
+            try:
+                super(GRVGithub, self).__init__(*args, **kwargs)
+            finally:
+                github.Requester.Requester.resetConnectionClasses()
+
+    def review_windows(self, gh_owner, gh_repo, since, until, phrases=None):
+        """Returns lib.grvtypes.ReviewWindows of the pulls merged in
+        [since, until) that have a comment with one of phrases.
+
+        Each window is one search of a merged: range, read to the end. The
+        search API stops at SEARCH_CAP results, so a range holding more is
+        split in halves until it does not.
+        """
+        query = review_query(phrases)
+        searched = datetime.datetime.utcnow() - SEARCH_LAG
+        results = self.search_issues("repo:%s/%s is:pr is:merged in:comments merged:%s..%s %s" % (
+            gh_owner, gh_repo, _search_time(since),
+            _search_time(until - datetime.timedelta(seconds=1)), query))
+        items = self._search_page(results, 0)
+        # totalCount requests again when the count is 0.
+        total = results.totalCount if items else 0
+        if total > SEARCH_CAP:
+            if until - since > SEARCH_MIN_WINDOW:
+                middle = since + (until - since) / 2
+                middle -= datetime.timedelta(microseconds=middle.microsecond)
+                return (self.review_windows(gh_owner, gh_repo, since, middle, phrases) +
+                        self.review_windows(gh_owner, gh_repo, middle, until, phrases))
+            logging.warning("Search finds %s reviewed pulls of %s/%s merged from %s to %s; "
+                            "only %s are read.", total, gh_owner, gh_repo, since, until,
+                            SEARCH_CAP)
+
+        reviewed = set()
+        page = 0
+        while items:
+            reviewed.update(issue.number for issue in items)
+            page += 1
+            if len(items) < self.per_page or page * self.per_page >= SEARCH_CAP:
                 break
-            
-            title = pull.title
-            base = pull.base.sha
-            head = pull.head.sha
-            number = pull.number
-            reviewer = None
-
-            if skip_pulls and "%s/%s" % (number, updated) in skip_pulls:
-                logging.info("we're skipping a pull")
-                continue
-
-            # Try to identify a reviewer
-            if not use_search or number in reviewed:
-                comments = repo.get_issue(number).get_comments()
-                for comment in comments:
-                    # Ignore if the commenter is the requester.
-                    if comment.user.login == pull.user.login:
-                        continue
-
-                    # Search for magic review words.
-                    comment_body = comment.body.lower()
-                    if re_review.search(comment_body):
-                        reviewer = comment.user.login
-                        break
+            items = self._search_page(results, page)
+        metrics.count("github.search_windows")
+        logging.info("%s reviewed pulls of %s/%s merged from %s to %s.", len(reviewed),
+                     gh_owner, gh_repo, since, until)
+        return [lib.grvtypes.ReviewWindow(gh_owner, gh_repo, query, since, until, searched,
+                                          frozenset(reviewed))]
+
+    def _search_page(self, results, page):
+        """Reads a page of search results, waiting out the search rate limit."""
+        while True:
+            try:
+                return results.get_page(page)
+            except github.RateLimitExceededException:
+                reset = self.get_rate_limit().search.reset
+                wait = max(1, (reset - datetime.datetime.utcnow()).total_seconds() + 1)
+                logging.warning("Search rate limit reached, waiting %ds.", wait)
+                time.sleep(wait)
 
+    def get_pull_pages(self, gh_owner, gh_repo, start_page=1, workers=1):
+        """Yields (page, pulls) for the closed pulls of a repo.
+
+        Pulls are most recently updated first, per_page to a page, and
+        pages are numbered from 1. An update moves a pull to the first
+        page, which only shifts the pulls after it later; so reading again
+        from start_page may see a pull twice but does not skip any.
+
+        With workers above 1 the pages after the one yielded are read
+        ahead in threads, still yielded in order. Up to 2 * workers empty
+        pages past the last are read, so it suits reading to the end.
+        """
+        repo = self.get_user(gh_owner).get_repo(gh_repo)
+        pulls = repo.get_pulls(state="closed", sort="updated", direction="desc")
+        get_page = lambda page: pulls.get_page(page - 1)
+        for page, items in _ordered_map(get_page, itertools.count(start_page), workers):
+            if not items:
+                return
+            metrics.count("github.pulls_read", len(items))
+            yield page, items
+
+    def get_comments_of(self, gh_owner, gh_repo, pulls, reviewed=None, comments_since=None):
+        """Yields (Pull, comments) for PyGithub pulls, in their order.
+
+        comments are the pull's lib.grvtypes.IssueComments, oldest first.
+        If reviewed is given, only pulls whose number is in it have their
+        comments fetched. comments_since is a dict of pull number to the
+        time its comments were last updated; for those pulls only the
+        comments updated since are fetched, and the reviewer found over
+        them alone.
+        """
+        get_comments = lambda pull: self._get_comments(gh_owner, gh_repo, pull, reviewed,
+                                                       comments_since)
+        return self._to_pulls(gh_owner, gh_repo, pulls, get_comments)
+
+    def _to_pulls(self, gh_owner, gh_repo, pulls, get_comments):
+        for pull, comments in _ordered_map(get_comments, pulls, self.comment_workers):
+            reviewer = find_reviewer(pull.user.login, comments)
             tpull = lib.grvtypes.Pull(
                     gh_owner=gh_owner,
                     gh_repo=gh_repo,
-                    pull_number=number,
+                    pull_number=pull.number,
                     pull_requester=pull.user.login,
-                    base_sha=base,
-                    head_sha=head,
+                    base_sha=pull.base.sha,
+                    head_sha=pull.head.sha,
                     pull_reviewer=reviewer,
                     merge_time=pull.merged_at,
-                    pull_title=title,
-                    pull_updated=updated,
+                    pull_title=pull.title,
+                    pull_updated=pull.updated_at,
                     merge_sha=None,
                     work_tickets=None
                     )
-            yield tpull
+            yield tpull, comments
+
+    def _get_comments(self, gh_owner, gh_repo, pull, reviewed=None, comments_since=None):
+        """Returns the comments of pull as lib.grvtypes.IssueComments.
+
+        If reviewed is given, only pulls whose number is in it have their
+        comments fetched.
+        """
+        if reviewed is not None and pull.number not in reviewed:
+            return []
+
+        parameters = {}
+        since = comments_since.get(pull.number) if comments_since else None
+        if since:
+            parameters["since"] = since.strftime("%Y-%m-%dT%H:%M:%SZ")
+        # The pull has the url of its issue; repo.get_issue would cost a
+        # request per pull to find it.
+        comments = github.PaginatedList.PaginatedList(
+            github.IssueComment.IssueComment, pull._requester,
+            pull.issue_url + "/comments", parameters)
+
+        tcomments = []
+        for comment in comments:
+            metrics.count("github.comments_read")
+            tcomments.append(lib.grvtypes.IssueComment(
+                gh_owner=gh_owner,
+                gh_repo=gh_repo,
+                gh_user=comment.user.login,
+                gh_user_id=str(comment.user.id),
+                update_time=comment.updated_at,
+                create_time=comment.created_at,
+                comment_id=comment.id,
+                issue_number=pull.number,
+                body=comment.body
+                ))
+        return tcomments
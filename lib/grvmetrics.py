@@ -0,0 +1,157 @@
+'''grvmetrics.py
+
+Wall time per phase, subprocess and API call timings, counters and gauges
+for one run, reported by grv.py --metrics / --metrics-json.
+
+test with python -m lib.grvmetrics
+'''
+import collections
+import contextlib
+import json
+import threading
+import time
+
+
+class Metrics(object):
+    """Collects the measures of a run. Safe to use from threads.
+
+    Phases nest, so their times are inclusive. Counters whose names end in
+    ".hit" and ".miss" are reported with their hit ratio.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.phases = collections.OrderedDict()
+            self.calls = {}
+            self.counters = collections.Counter()
+            self.gauges = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Times the block as the phase name."""
+        start = time.time()
+        with self.lock:
+            self.phases.setdefault(name, [0, 0.0])
+        try:
+            yield
+        finally:
+            self._add(self.phases, name, time.time() - start)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Times the block as one call of name, e.g. a git process."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start)
+
+    def record(self, name, seconds):
+        """Adds one call of name that took seconds."""
+        self._add(self.calls, name, seconds)
+
+    def _add(self, timings, name, seconds):
+        with self.lock:
+            timing = timings.setdefault(name, [0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def gauge(self, name, value):
+        """Keeps the last value seen of name, e.g. the rate limit left."""
+        with self.lock:
+            self.gauges[name] = value
+
+    def summary(self):
+        """Returns the measures as a dict that can be dumped as json."""
+        with self.lock:
+            ratios = {}
+            for name in self.counters:
+                if name.endswith(".hit"):
+                    prefix = name[:-len(".hit")]
+                    hits = self.counters[name]
+                    total = hits + self.counters.get(prefix + ".miss", 0)
+                    ratios[prefix] = round(float(hits) / total, 4) if total else None
+            return {
+                "phases": [{"name": k, "count": v[0], "seconds": round(v[1], 3)}
+                           for k, v in self.phases.items()],
+                "calls": dict((k, {"count": v[0], "seconds": round(v[1], 3)})
+                              for k, v in self.calls.items()),
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "hit_ratios": ratios,
+                }
+
+    def merge(self, summary):
+        """Adds a summary from another process, e.g. a pool worker."""
+        with self.lock:
+            for phase in summary["phases"]:
+                timing = self.phases.setdefault(phase["name"], [0, 0.0])
+                timing[0] += phase["count"]
+                timing[1] += phase["seconds"]
+            for name, call in summary["calls"].items():
+                timing = self.calls.setdefault(name, [0, 0.0])
+                timing[0] += call["count"]
+                timing[1] += call["seconds"]
+            self.counters.update(summary["counters"])
+            self.gauges.update(summary["gauges"])
+
+    def format(self):
+        """Returns the summary as text, one measure per line."""
+        summary = self.summary()
+        lines = ["Phases:"]
+        for phase in summary["phases"]:
+            lines.append("  %-32s %6d %10.3fs" % (phase["name"], phase["count"],
+                                                  phase["seconds"]))
+        lines.append("Calls:")
+        for name, call in sorted(summary["calls"].items()):
+            lines.append("  %-32s %6d %10.3fs" % (name, call["count"], call["seconds"]))
+        lines.append("Counters:")
+        for name, value in sorted(summary["counters"].items()):
+            lines.append("  %-32s %6d" % (name, value))
+        for name, value in sorted(summary["gauges"].items()):
+            lines.append("  %-32s %6s" % (name, value))
+        for name, ratio in sorted(summary["hit_ratios"].items()):
+            lines.append("  %-32s %6s" % (name + " hit ratio", ratio))
+        return "\n".join(lines)
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, sort_keys=True, indent=4, separators=(',', ': '))
+            f.write("\n")
+
+
+metrics = Metrics()
+
+
+if __name__ == "__main__":
+    # run with python -m lib.grvmetrics
+    m = Metrics()
+    with m.phase("outer"):
+        with m.phase("inner"):
+            with m.timer("git log"):
+                pass
+    with m.phase("inner"):
+        pass
+    m.count("stats_cache.hit", 3)
+    m.count("stats_cache.miss")
+    m.gauge("github.rate_limit_remaining", 4999)
+    s = m.summary()
+    assert [p["name"] for p in s["phases"]] == ["outer", "inner"]
+    assert s["phases"][1]["count"] == 2
+    assert s["calls"]["git log"]["count"] == 1
+    assert s["hit_ratios"]["stats_cache"] == 0.75
+    assert s["gauges"]["github.rate_limit_remaining"] == 4999
+
+    m.merge(json.loads(json.dumps(s)))
+    s = m.summary()
+    assert s["phases"][1]["count"] == 4
+    assert s["counters"]["stats_cache.hit"] == 6
+    print m.format()
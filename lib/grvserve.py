@@ -0,0 +1,349 @@
+'''grvserve.py
+
+Keeps the database up to date from GitHub webhooks, with the database
+connections and git processes kept open between events.
+
+Try it with recorded payloads:
+    curl -H 'X-GitHub-Event: push' -d @push.json localhost:8025
+'''
+import BaseHTTPServer
+import datetime
+import hashlib
+import hmac
+import json
+import logging
+
+import grvdb
+import grvgit
+import grvgithub
+import grvtypes
+import operations
+from grvmetrics import metrics
+
+
+def _parse_time(value):
+    """Parses a webhook timestamp to a naive UTC datetime, as PyGithub does."""
+    if not value:
+        return None
+    return datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ")
+
+
+class Watcher(object):
+    """Applies webhook events to the database of a config.
+
+    pull_request events store merged pulls, issue_comment events store
+    comments and find the reviewer of their pull again, and push events
+    fetch the branch and store the commits added to it.
+    """
+
+    def __init__(self, config, repos, review_phrases=None):
+        self.db_file = config["paths"]["database"]
+        self.repos = repos
+        self.pattern = grvgithub.review_pattern(review_phrases)
+        self.pdb = grvdb.Pulls(self.db_file)
+        self.icdb = grvdb.IssueComments(self.db_file)
+        self.handlers = {
+            "ping": self.on_ping,
+            "pull_request": self.on_pull_request,
+            "issue_comment": self.on_issue_comment,
+            "push": self.on_push,
+            }
+
+    def handle(self, event, payload):
+        """Applies one event. Returns a dict saying what was done."""
+        metrics.count("serve.events.%s" % event)
+        handler = self.handlers.get(event)
+        if not handler:
+            return {"ignored": "event %s" % event}
+        with metrics.phase("serve %s" % event):
+            return handler(payload)
+
+    def _repos_of(self, payload):
+        repository = payload["repository"]
+        gh_owner, gh_repo = repository["owner"]["login"], repository["name"]
+        return gh_owner, gh_repo, [r for r in self.repos if r["github_owner"] == gh_owner
+                                   and r["github_repo"] == gh_repo]
+
+    def on_ping(self, payload):
+        return {"pong": payload.get("zen")}
+
+    def on_pull_request(self, payload):
+        gh_owner, gh_repo, repos = self._repos_of(payload)
+        pull = payload["pull_request"]
+        if not repos:
+            return {"ignored": "repo %s/%s" % (gh_owner, gh_repo)}
+        if not pull.get("merged_at"):
+            return {"ignored": "pull %s is not merged" % pull["number"]}
+
+        requester = pull["user"]["login"]
+        comments = self.icdb.get_for_issue(gh_owner, gh_repo, pull["number"])
+        if comments:
+            reviewer = grvgithub.find_reviewer(requester, comments, self.pattern)
+        else:
+            # Comments made before serve started, or before they were
+            # stored, are not here; keep the reviewer found from them, as
+            # recompute_reviewers does.
+            stored = self.pdb.get_pull(gh_owner, gh_repo, pull["number"])
+            reviewer = stored.pull_reviewer if stored else None
+        tpull = grvtypes.Pull(
+            gh_owner=gh_owner,
+            gh_repo=gh_repo,
+            pull_number=pull["number"],
+            pull_requester=requester,
+            base_sha=pull["base"]["sha"],
+            head_sha=pull["head"]["sha"],
+            pull_reviewer=reviewer,
+            merge_time=_parse_time(pull["merged_at"]),
+            pull_title=pull["title"],
+            pull_updated=_parse_time(pull["updated_at"]),
+            merge_sha=None,
+            work_tickets=None
+            )
+        self.pdb.add_pulls([tpull])
+        return {"pull": tpull.pull_number, "reviewer": tpull.pull_reviewer}
+
+    def on_issue_comment(self, payload):
+        gh_owner, gh_repo, repos = self._repos_of(payload)
+        issue, comment = payload["issue"], payload["comment"]
+        if not repos:
+            return {"ignored": "repo %s/%s" % (gh_owner, gh_repo)}
+        if "pull_request" not in issue:
+            return {"ignored": "issue %s is not a pull" % issue["number"]}
+
+        # Comments made before serve started may not be stored. Without
+        # any, this event alone cannot show there was no review.
+        stored_comments = self.icdb.get_for_issue(gh_owner, gh_repo, issue["number"])
+        if payload.get("action") == "deleted":
+            self.icdb.delete_comment(gh_owner, gh_repo, comment["id"])
+        else:
+            self.icdb.add_comments([grvtypes.IssueComment(
+                gh_owner=gh_owner,
+                gh_repo=gh_repo,
+                gh_user=comment["user"]["login"],
+                gh_user_id=str(comment["user"]["id"]),
+                update_time=_parse_time(comment["updated_at"]),
+                create_time=_parse_time(comment["created_at"]),
+                comment_id=comment["id"],
+                issue_number=issue["number"],
+                body=comment["body"]
+                )])
+
+        comments = self.icdb.get_for_issue(gh_owner, gh_repo, issue["number"])
+        reviewer = grvgithub.find_reviewer(issue["user"]["login"], comments, self.pattern)
+        if reviewer is None and not stored_comments:
+            stored = self.pdb.get_pull(gh_owner, gh_repo, issue["number"])
+            reviewer = stored.pull_reviewer if stored else None
+            return {"pull": issue["number"], "reviewer": reviewer, "changed": 0}
+        # Only pulls already stored as merged are updated.
+        changed = self.pdb.set_reviewers(gh_owner, gh_repo, [(issue["number"], reviewer)])
+        return {"pull": issue["number"], "reviewer": reviewer, "changed": changed}
+
+    def on_push(self, payload):
+        _, _, repos = self._repos_of(payload)
+        ref = payload.get("ref", "")
+        res = {}
+        for repo in repos:
+            if ref != "refs/heads/%s" % repo["branch"]:
+                continue
+            head = grvgit.update(repo["git_repo_dir"], repo["branch"])
+            res[repo["label"]] = operations.update_commits(
+                self.db_file, repo["label"], repo["git_repo_dir"], repo["branch"])
+            logging.info("%s is at %s, %s commits added.", repo["label"], head,
+                         res[repo["label"]])
+        if not res:
+            return {"ignored": "ref %s" % ref}
+        return {"commits_added": res}
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not self.server.verify(body, self.headers):
+            return self.reply(401, {"error": "bad signature"})
+        event = self.headers.get("X-GitHub-Event")
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            return self.reply(400, {"error": "payload is not json"})
+        try:
+            res = self.server.watcher.handle(event, payload)
+        except (KeyError, TypeError) as e:
+            logging.warning("Bad %s payload: %r", event, e)
+            return self.reply(400, {"error": "bad %s payload" % event})
+        except Exception as e:
+            logging.exception("Failed to handle %s.", event)
+            return self.reply(500, {"error": str(e)})
+        logging.info("%s: %s", event, res)
+        self.reply(200, res)
+
+    def do_GET(self):
+        self.reply(200, metrics.summary())
+
+    def reply(self, status, body):
+        data = json.dumps(body)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.info("%s - %s", self.address_string(), format % args)
+
+
+class WebhookServer(BaseHTTPServer.HTTPServer):
+    """Serves webhook POSTs one at a time, so the sqlite connections stay
+    on one thread. A GET returns the metrics so far.
+
+    If secret is set, payloads must be signed with it as GitHub does in
+    X-Hub-Signature-256 (or X-Hub-Signature).
+    """
+
+    def __init__(self, address, watcher, secret=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, _Handler)
+        self.watcher = watcher
+        self.secret = secret
+
+    def verify(self, body, headers):
+        if not self.secret:
+            return True
+        for header, name, digest in (("X-Hub-Signature-256", "sha256", hashlib.sha256),
+                                     ("X-Hub-Signature", "sha1", hashlib.sha1)):
+            signature = headers.get(header)
+            if signature:
+                expected = "%s=%s" % (name,
+                                      hmac.new(str(self.secret), body, digest).hexdigest())
+                return hmac.compare_digest(str(signature), expected)
+        return False
+
+
+def serve(config, repos, host="127.0.0.1", port=8025):
+    """Serves webhooks for repos until interrupted."""
+    options = config.get("serve", {})
+    watcher = Watcher(config, repos, config.get("review_phrases"))
+    server = WebhookServer((host, port), watcher, options.get("secret"))
+    logging.warning("Listening for webhooks on %s:%s", *server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    # Posts recorded payloads to a server on localhost.
+    # run with python -m lib.grvserve
+    import os
+    import shutil
+    import subprocess
+    import tempfile
+    import threading
+    import urllib2
+    logging.basicConfig(level=logging.DEBUG)
+
+    logging.info("Making a repo with an origin.")
+    tmp = tempfile.mkdtemp()
+    origin, work, clone = [os.path.join(tmp, d) for d in ("origin", "work", "clone")]
+    env = dict(os.environ, GIT_AUTHOR_NAME="test user", GIT_AUTHOR_EMAIL="test@example.com",
+               GIT_COMMITTER_NAME="test user", GIT_COMMITTER_EMAIL="test@example.com")
+    def git(cwd, *args):
+        return subprocess.check_output(("git",) + args, cwd=cwd, env=env).strip()
+    git(tmp, "init", "--quiet", "--bare", origin)
+    git(tmp, "init", "--quiet", work)
+    git(work, "remote", "add", "origin", origin)
+    git(work, "checkout", "--quiet", "-b", "master")
+    git(work, "commit", "--quiet", "--allow-empty", "-m", "first")
+    git(work, "push", "--quiet", "origin", "master")
+    git(tmp, "clone", "--quiet", "--branch", "master", origin, clone)
+
+    config = {"paths": {"database": os.path.join(tmp, "grv.db")}}
+    repos = [{"label": "repo-master", "github_owner": "owner", "github_repo": "repo",
+              "git_repo_dir": clone, "branch": "master"}]
+    # The server keeps its connections on the thread it serves from.
+    servers, ready = [], threading.Event()
+    def run():
+        servers.append(WebhookServer(("127.0.0.1", 0), Watcher(config, repos),
+                                     secret="s3cret"))
+        ready.set()
+        servers[0].serve_forever()
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    ready.wait()
+    server = servers[0]
+    pdb = grvdb.Pulls(config["paths"]["database"])
+
+    def post(event, payload, secret="s3cret"):
+        body = json.dumps(payload)
+        headers = {"X-GitHub-Event": event, "Content-Type": "application/json"}
+        if secret:
+            headers["X-Hub-Signature-256"] = "sha256=%s" % hmac.new(
+                secret, body, hashlib.sha256).hexdigest()
+        request = urllib2.Request("http://127.0.0.1:%s/" % server.server_address[1],
+                                  body, headers)
+        try:
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError as e:
+            response = e
+        return response.getcode(), json.loads(response.read())
+
+    repository = {"name": "repo", "owner": {"login": "owner"}}
+    pull = {"number": 7, "user": {"login": "requester"}, "title": "A pull",
+            "base": {"sha": "a" * 40}, "head": {"sha": "b" * 40},
+            "merged_at": "2015-04-17T13:07:13Z", "updated_at": "2015-04-17T13:07:13Z"}
+    comment = {"id": 70, "user": {"login": "reviewer", "id": 2}, "body": "LGTM",
+               "created_at": "2015-04-17T13:00:00Z", "updated_at": "2015-04-17T13:00:00Z"}
+
+    logging.info("Signatures are checked.")
+    payload = {"action": "closed", "pull_request": pull, "repository": repository}
+    assert post("pull_request", payload, secret=None)[0] == 401
+    assert post("pull_request", payload, secret="wrong")[0] == 401
+    assert pdb.get_pull("owner", "repo", 7) is None
+    assert post("ping", {"zen": "Keep it simple."}) == (200, {"pong": "Keep it simple."})
+
+    logging.info("A merged pull is stored.")
+    assert post("pull_request", payload) == (200, {"pull": 7, "reviewer": None})
+    other = dict(pull, merged_at=None, number=8)
+    assert post("pull_request", {"pull_request": other, "repository": repository})[0] == 200
+    assert pdb.get_pull("owner", "repo", 8) is None
+    assert post("pull_request", {"repository": repository})[0] == 400
+
+    logging.info("A comment finds the reviewer.")
+    issue = {"number": 7, "user": {"login": "requester"}, "pull_request": {}}
+    assert post("issue_comment", {"action": "created", "issue": issue, "comment": comment,
+                                  "repository": repository}) == (
+        200, {"pull": 7, "reviewer": "reviewer", "changed": 1})
+    assert pdb.get_pull("owner", "repo", 7).pull_reviewer == "reviewer"
+
+    logging.info("A pull without stored comments keeps its reviewer.")
+    pdb.add_pulls([pdb.get_pull("owner", "repo", 7)._replace(
+        pull_number="9")])
+    assert post("pull_request", {"pull_request": dict(pull, number=9),
+                                 "repository": repository}) == (
+        200, {"pull": 9, "reviewer": "reviewer"})
+    thanks = dict(comment, id=2, body="thanks", user={"login": "other", "id": 3})
+    assert post("issue_comment", {"action": "created", "issue": dict(issue, number=9),
+                                  "comment": thanks, "repository": repository}) == (
+        200, {"pull": 9, "reviewer": "reviewer", "changed": 0})
+    assert pdb.get_pull("owner", "repo", 9).pull_reviewer == "reviewer"
+
+    logging.info("Deleting the comment clears it.")
+    assert post("issue_comment", {"action": "deleted", "issue": issue, "comment": comment,
+                                  "repository": repository})[1]["reviewer"] is None
+    assert pdb.get_pull("owner", "repo", 7).pull_reviewer is None
+
+    logging.info("A push stores the new commits.")
+    git(work, "commit", "--quiet", "--allow-empty", "-m", "second")
+    git(work, "push", "--quiet", "origin", "master")
+    assert post("push", {"ref": "refs/heads/other", "repository": repository})[1] == {
+        "ignored": "ref refs/heads/other"}
+    assert post("push", {"ref": "refs/heads/master", "repository": repository}) == (
+        200, {"commits_added": {"repo-master": 2}})
+    cdb = grvdb.Commits(config["paths"]["database"])
+    assert cdb.get_head("repo-master") == git(work, "rev-parse", "HEAD")
+
+    server.shutdown()
+    server.server_close()
+    shutil.rmtree(tmp)
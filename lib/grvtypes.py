@@ -1,5 +1,7 @@
 #types.py
 
+import array
+import binascii
 import collections
 
 
@@ -49,4 +51,156 @@ IssueComment = collections.namedtuple("IssueComment", (
         'comment_id',
         'issue_number',
         'body'
-        ))
\ No newline at end of file
+        ))
+
+PullSync = collections.namedtuple("PullSync", (
+        'gh_owner',
+        'gh_repo',
+        'watermark',
+        'page',
+        'per_page',
+        'stop',
+        'target'
+        ))
+
+ReviewWindow = collections.namedtuple("ReviewWindow", (
+        'gh_owner',
+        'gh_repo',
+        'query',
+        'since',
+        'until',
+        'searched',
+        'reviewed'
+        ))
+
+class CommitStore(object):
+    """A compact, append-only sequence of Commits for long histories.
+
+    Shas are kept as 20 raw bytes, committer names and emails are stored
+    once each, and times and diff counts sit in arrays, so a commit costs
+    tens of bytes instead of a tuple of Python strings. File lists are not
+    kept: reading a commit loads its files through files_loader(sha,
+    parent) when one is set, and gives None otherwise.
+
+    Reading an index builds a Commit; pr_number and pr_reviewer are None.
+    """
+    NONE = -1
+
+    def __init__(self, commits=(), files_loader=None):
+        self.files_loader = files_loader
+        self._shas = bytearray()
+        self._parents = bytearray()
+        self._merge_parents = {}
+        self._people = []
+        self._people_index = {}
+        self._person = array.array('l')
+        self._time = array.array('l')
+        self._added = array.array('l')
+        self._removed = array.array('l')
+        self._files = array.array('l')
+        self.extend(commits)
+
+    def _int(self, value):
+        return self.NONE if value is None else int(value)
+
+    def _value(self, value):
+        return None if value == self.NONE else value
+
+    def append(self, commit):
+        index = len(self._time)
+        self._shas += binascii.unhexlify(commit.hexsha)
+        parents = [p for p in commit.parents if p]
+        self._parents += binascii.unhexlify(parents[0]) if parents else '\0' * 20
+        if len(parents) > 1:
+            self._merge_parents[index] = tuple(
+                binascii.unhexlify(p) for p in parents[1:])
+
+        person = (commit.author, commit.email)
+        if person not in self._people_index:
+            self._people_index[person] = len(self._people)
+            self._people.append(person)
+        self._person.append(self._people_index[person])
+
+        self._time.append(self._int(commit.time))
+        self._added.append(self._int(commit.ct_added))
+        self._removed.append(self._int(commit.ct_removed))
+        self._files.append(self._int(commit.ct_files))
+
+    def extend(self, commits):
+        for commit in commits:
+            self.append(commit)
+
+    def __len__(self):
+        return len(self._time)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+
+        hexsha = binascii.hexlify(self._shas[index * 20:index * 20 + 20])
+        parent = self._parents[index * 20:index * 20 + 20]
+        parents = ('',)
+        if any(parent):
+            parents = (binascii.hexlify(parent),) + tuple(
+                binascii.hexlify(p) for p in self._merge_parents.get(index, ()))
+        author, email = self._people[self._person[index]]
+
+        files = None
+        if self.files_loader:
+            files = self.files_loader(hexsha, parents[0])
+        return Commit(
+            hexsha,
+            parents,
+            author,
+            email,
+            str(self._time[index]),
+            self._value(self._added[index]),
+            self._value(self._removed[index]),
+            self._value(self._files[index]),
+            files,
+            None,
+            None
+            )
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+
+
+if __name__ == "__main__":
+    # run with python -m lib.grvtypes
+    import pickle
+
+    root = Commit("a" * 40, ("",), "test user", "test@example.com", "1416000000",
+                  1, 0, 1, None, None, None)
+    merge = root._replace(hexsha="c" * 40, parents=("a" * 40, "b" * 40, "d" * 40, "e" * 40),
+                          time="1416000100", ct_added=None, ct_removed=None, ct_files=None)
+    other = root._replace(hexsha="f" * 40, parents=("c" * 40,), author="other user",
+                          email="other@example.com", time="1416000200")
+    again = root._replace(hexsha="0" * 39 + "1", parents=("f" * 40,), time="1416000300")
+    commits = [root, merge, other, again]
+
+    store = CommitStore(commits)
+    assert len(store) == 4
+    assert list(store) == commits
+    assert store[0].parents == ("",)
+    assert store[1].parents == ("a" * 40, "b" * 40, "d" * 40, "e" * 40)
+    assert (store[1].ct_added, store[1].ct_removed, store[1].ct_files) == (None, None, None)
+    assert store._people == [("test user", "test@example.com"),
+                             ("other user", "other@example.com")]
+    assert store[-1] == again and store[-4] == root
+    for index in (4, -5):
+        try:
+            store[index]
+            assert False, index
+        except IndexError:
+            pass
+
+    for protocol in (0, pickle.HIGHEST_PROTOCOL):
+        assert list(pickle.loads(pickle.dumps(store, protocol))) == commits
+
+    loaded = CommitStore(commits[:2], files_loader=lambda sha, parent: [sha[:1], parent])
+    assert loaded[0].files == ["a", ""]
+    assert loaded[1].files == ["c", "a" * 40]
@@ -1,83 +1,333 @@
 #operations.py
 
 import collections
+import datetime
 import logging
 
 import grvdb
 import grvgit
 import grvgithub
+from grvmetrics import metrics
 import grvtypes
 
 
-def update_pulls(db_file, gh_user, gh_owner, gh_repo):
+def update_pulls(db_file, gh_user, gh_owner, gh_repo, review_phrases=None, use_search=False,
+                 **gh_options):
+    """Stores the pulls of a repo updated since its watermark."""
+    return sync_pulls(db_file, gh_user, gh_owner, gh_repo, False, review_phrases, use_search,
+                      **gh_options)
+
+
+def init_pulls(db_file, gh_user, gh_owner, gh_repo, review_phrases=None, use_search=False,
+               **gh_options):
+    """Similar to update pulls, except don't check last-update."""
+    return sync_pulls(db_file, gh_user, gh_owner, gh_repo, True, review_phrases, use_search,
+                      **gh_options)
+
+
+class _ReviewSearch(object):
+    """Picks the pulls of a repo whose comments are worth reading.
+
+    Those are the pulls search finds an approving comment on, looked up
+    in the review windows of their merge month. Windows are searched when
+    first needed and kept in the database. A pull updated since its window
+    was searched may have new comments: the month is searched again, once
+    a run, and the pull read anyway if it is still newer.
+    """
+
+    def __init__(self, pdb, gh_conn, gh_owner, gh_repo, review_phrases):
+        self.pdb = pdb
+        self.gh_conn = gh_conn
+        self.gh_owner = gh_owner
+        self.gh_repo = gh_repo
+        self.review_phrases = review_phrases
+        self.query = grvgithub.review_query(review_phrases)
+        self.months = {}
+        self.searched = set()
+
+    def _windows(self, month, search=False):
+        if search or month not in self.months:
+            windows = []
+            if not search:
+                windows = self.pdb.get_review_windows(self.gh_owner, self.gh_repo,
+                                                      self.query, *month)
+            if not windows:
+                windows = self.gh_conn.review_windows(self.gh_owner, self.gh_repo,
+                                                      month[0], month[1], self.review_phrases)
+                self.pdb.save_review_windows(windows)
+                self.searched.add(month)
+            self.months[month] = windows
+        return self.months[month]
+
+    def _window(self, merged, search=False):
+        since = merged.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        month = (since, (since + datetime.timedelta(days=32)).replace(day=1))
+        if search and month in self.searched:
+            search = False
+        for window in self._windows(month, search):
+            if window.since <= merged < window.until:
+                return window
+        return None
+
+    def reviewed(self, pulls):
+        """Returns the numbers of those PyGithub pulls to read comments of."""
+        numbers = set()
+        for pull in pulls:
+            window = self._window(pull.merged_at)
+            if window and pull.updated_at > window.searched:
+                window = self._window(pull.merged_at, search=True)
+            if (not window or pull.number in window.reviewed
+                    or pull.updated_at > window.searched):
+                numbers.add(pull.number)
+        return numbers
+
+
+def sync_pulls(db_file, gh_user, gh_owner, gh_repo, full, review_phrases=None, use_search=False,
+               **gh_options):
+    """Stores the merged pulls of a repo, a page of pulls at a time.
+
+    The pass stops at the repo's watermark unless full. Each page is
+    committed along with the next page to read, so a pass that was killed
+    goes on from where it stopped, and the watermark only moves once the
+    pass is done. Pulls stored with the same updated time are skipped.
+
+    With use_search, comments are only read for pulls the search API
+    finds approving comments on, see _ReviewSearch.
+
+    Return:
+        A (inserted, updated) tuple of row counts.
+    """
     pdb = grvdb.Pulls(db_file)
-    gh_conn = grvgithub.GRVGithub(gh_user)
+    icdb = grvdb.IssueComments(db_file)
+    gh_conn = grvgithub.GRVGithub(gh_user, **gh_options)
+    per_page = gh_conn.per_page
 
-    last_update_time = pdb.get_last_update()
-    pulls = gh_conn.get_pulls(gh_owner, gh_repo, last_update_time=last_update_time)
- 
-    for pull in pulls:
-        pdb.add_pull(pull)
+    sync = pdb.get_sync(gh_owner, gh_repo)
+    if sync.page:
+        logging.info("Resuming %s/%s at page %s.", gh_owner, gh_repo, sync.page)
+        if sync.per_page != per_page:
+            # The page holding the first pull not read yet.
+            sync = sync._replace(page=(sync.page - 1) * sync.per_page // per_page + 1,
+                                 per_page=per_page)
+        if full:
+            sync = sync._replace(stop=None)
+    else:
+        sync = sync._replace(page=1, per_page=per_page,
+                             stop=None if full else sync.watermark, target=None)
 
+    # A backfill reads to the end, so it reads pages ahead; an update
+    # mostly stops on its first page.
+    workers = gh_conn.page_workers if full else 1
+    search = None
+    if use_search:
+        search = _ReviewSearch(pdb, gh_conn, gh_owner, gh_repo, review_phrases)
+    comments_since = icdb.get_last_updates(gh_owner, gh_repo)
+    inserted, updated = 0, 0
+    with metrics.phase("fetch and store pulls"):
+        for page, pulls in gh_conn.get_pull_pages(gh_owner, gh_repo, sync.page, workers):
+            if sync.target is None:
+                sync = sync._replace(target=pulls[0].updated_at)
+            done = False
+            if sync.stop:
+                newer = [p for p in pulls if p.updated_at >= sync.stop]
+                done = len(newer) < len(pulls)
+                pulls = newer
 
-def init_pulls(db_file, gh_user, gh_owner, gh_repo):
-    """Similar to update pulls, except don't check last-update."""
+            stored = pdb.get_updated(gh_owner, gh_repo, [p.number for p in pulls])
+            # merged_at is in the list response; pull.merged would cost a
+            # request per pull to complete the object.
+            pulls = [p for p in pulls
+                     if p.merged_at is not None and stored.get(p.number) != p.updated_at]
+            reviewed = search.reviewed(pulls) if search else None
+            pairs = gh_conn.get_comments_of(gh_owner, gh_repo, pulls, reviewed, comments_since)
+            ct_inserted, ct_updated = pdb.add_pulls(
+                store_comments(icdb, pairs, comments_since, review_phrases))
+            inserted, updated = inserted + ct_inserted, updated + ct_updated
+
+            sync = sync._replace(page=page + 1)
+            pdb.save_sync(sync)
+            if done:
+                logging.info("Reached the watermark %s of %s/%s on page %s.",
+                             sync.stop, gh_owner, gh_repo, page)
+                break
+
+        # target is None when no page was read; None does not compare
+        # with a datetime.
+        marks = [w for w in (sync.watermark, sync.target) if w]
+        watermark = max(marks) if marks else None
+        pdb.save_sync(sync._replace(watermark=watermark, page=None, per_page=None,
+                                    stop=None, target=None))
+    if gh_conn.http_cache:
+        gh_conn.http_cache.log_stats()
+    return inserted, updated
+
+
+def store_comments(icdb, pulls, comments_since, review_phrases=None, batch_size=500):
+    """Stores the comments fetched with pulls and yields the pulls.
+
+    A pull whose comments were fetched only since comments_since gets its
+    reviewer found again over all of its comments, stored and new.
+    Comments are written batch_size at a time.
+    """
+    pattern = grvgithub.review_pattern(review_phrases)
+    batch = []
+    try:
+        for pull, comments in pulls:
+            if pull.pull_number in comments_since:
+                merged = dict((c.comment_id, c) for c in icdb.get_for_issue(
+                    pull.gh_owner, pull.gh_repo, pull.pull_number))
+                merged.update((c.comment_id, c) for c in comments)
+                comments = sorted(merged.values(), key=lambda c: (c.create_time, c.comment_id))
+            pull = pull._replace(pull_reviewer=grvgithub.find_reviewer(
+                pull.pull_requester, comments, pattern))
+
+            batch.extend(comments)
+            if len(batch) >= batch_size:
+                icdb.add_comments(batch)
+                batch = []
+            yield pull
+    finally:
+        icdb.add_comments(batch)
+
+
+def recompute_reviewers(db_file, gh_owner, gh_repo, review_phrases=None):
+    """Finds the reviewer of each pull again from its stored comments.
+
+    Nothing is fetched, so this is how a change of review_phrases is
+    applied. Pulls without stored comments are left as they are.
+
+    Return:
+        The number of pulls whose reviewer changed.
+    """
     pdb = grvdb.Pulls(db_file)
-    gh_conn = grvgithub.GRVGithub(gh_user)
-
-    current_pulls = ("%s/%s" % (p.pull_number, p.pull_updated) for p in pdb.readall())
-
-    for pull in gh_conn.get_pulls(gh_owner, gh_repo, skip_pulls=current_pulls):
-        pdb.add_pull(pull)
-
-
-def get_commits_with_pull(db_file, repo_dir, branch):
-    """Scan pulls and repo mapping merges to pulls."""
-    pullsdb = grvdb.Pulls(db_file)
-    pulls = pullsdb.readall()
-
-    commits = grvgit.get_all_commits(repo_dir, branch)
-    logging.info("ct commits %s", len(commits))
-    commit_index = {}
-    for commit in commits:
-        commit_index[commit.hexsha] = commit
-
-    merges = [c for c in commits if len(c.parents) > 1]
-    merge_heads = {}
-    for merge in merges:
-        merge_heads[merge.parents[1]] = merge
-
-    # map merges to pulls
-    for pull in pulls:
-        if pull.head_sha in merge_heads:
-            merge = merge_heads[pull.head_sha]
-            c = commit_index[merge.hexsha]
-
-            commit_index[c.hexsha] = grvtypes.Commit(
-                    c.hexsha,
-                    c.parents,
-                    c.author,
-                    c.email,
-                    c.time,
-                    c.ct_added,
-                    c.ct_removed,
-                    c.ct_files,
-                    c.files,
-                    pull.pull_number,
-                    pull.pull_reviewer
-                )
-
-    res = [commit_index[c.hexsha] for c in commits]
-    logging.info("ct res: %s", len(res))
-    return res
-
-def report_violations(db_file, repo_dir, branch):
-    commits = get_commits_with_pull(db_file, repo_dir, branch)
-    return [c for c in commits if not c.pr_reviewer]
-
-def report_all(db_file, repo_dir, branch):
-    commits = get_commits_with_pull(db_file, repo_dir, branch)
+    icdb = grvdb.IssueComments(db_file)
+    pattern = grvgithub.review_pattern(review_phrases)
+
+    requesters = dict((p.pull_number, p.pull_requester) for p in pdb.get_pulls_for_repo(
+        grvtypes.Repo(gh_owner, gh_repo, None, None)))
+    reviewers = [(number, grvgithub.find_reviewer(requesters[number], comments, pattern))
+                 for number, comments in icdb.get_for_repo(gh_owner, gh_repo)
+                 if number in requesters]
+    changed = pdb.set_reviewers(gh_owner, gh_repo, reviewers)
+    logging.info("Reviewers checked: %s, changed: %s", len(reviewers), changed)
+    return changed
+
+
+def update_commits(db_file, label, repo_dir, branch, stats=False, jobs=1):
+    """Stores the commits added to branch since label was last scanned.
+
+    Only last_head..HEAD is walked. If the stored head is no longer an
+    ancestor of the branch (a force-push), the label is rescanned. Diff
+    stats are only read, in the same git stream, if stats is set. A long
+    walk is split over jobs processes, see grvgit.log_list_sharded.
+    """
+    with metrics.phase("update commits"):
+        return _update_commits(db_file, label, repo_dir, branch, stats, jobs)
+
+
+def _update_commits(db_file, label, repo_dir, branch, stats, jobs):
+    cdb = grvdb.Commits(db_file)
+    head = grvgit.head(repo_dir, branch)
+    last_head = cdb.get_head(label)
+    if last_head == head:
+        return 0
+
+    # A head dropped by a force-push, even one pruned since, is not an
+    # ancestor and the label is scanned again.
+    if last_head and grvgit.is_ancestor(repo_dir, last_head, head):
+        rev_range = "%s..%s" % (last_head, head)
+    else:
+        if last_head:
+            logging.warning("%s is no longer on %s, rescanning %s.",
+                            last_head, branch, label)
+        cdb.clear(label)
+        rev_range = head
+
+    commits = grvgit.log_list_sharded(repo_dir, rev_range, jobs, stats)
+    return cdb.add_commits(label, commits, head)
+
+
+def get_commits_with_pull(db_file, label, repo_dir, branch, gh_owner, gh_repo, since=None,
+                          reviewed=None):
+    """Yields the commits of branch, newest first, with the pull each merges.
+
+    They are read from the report table, which is kept current as commits
+    and pulls are stored.
+
+    Args:
+        since: if set, only commits from this unix time on.
+        reviewed: if True or False, only reviewed or unreviewed commits.
+    """
+    update_commits(db_file, label, repo_dir, branch)
+    rdb = grvdb.Reports(db_file)
+    rdb.track(label, gh_owner, gh_repo)
+    return rdb.get_commits(label, since, reviewed)
+
+
+def query_report(db_file, label, gh_owner, gh_repo, since=None, until=None, email=None,
+                 type_=None, reviewed=None):
+    """Yields report rows of label from the database alone.
+
+    Unlike report_all, neither git nor GitHub is read; the report is as
+    fresh as the last update-repo and update-pulls, or serve.
+    """
+    rdb = grvdb.Reports(db_file)
+    rdb.track(label, gh_owner, gh_repo)
+    return rdb.query(label, since, until, email, type_, reviewed)
+
+
+def report_violations(db_file, label, repo_dir, branch, gh_owner, gh_repo, since=None,
+                      stats=False):
+    commits = get_commits_with_pull(db_file, label, repo_dir, branch, gh_owner, gh_repo, since,
+                                    reviewed=False)
+    if stats:
+        commits = grvgit.with_stats(repo_dir, commits)
+    return commits
+
+
+def report_all(db_file, label, repo_dir, branch, gh_owner, gh_repo, since=None, stats=False):
+    commits = get_commits_with_pull(db_file, label, repo_dir, branch, gh_owner, gh_repo, since)
+    if stats:
+        commits = grvgit.with_stats(repo_dir, commits)
     return commits
 
 
+if __name__ == "__main__":
+    # Runs against a fake GitHub on localhost.
+    # run with python -m lib.operations
+    import os
+    import shutil
+    import tempfile
+    import time
+    import bench.fakegithub
+    logging.basicConfig(level=logging.DEBUG)
+
+    tmp = tempfile.mkdtemp()
+    db_file = os.path.join(tmp, "grv.db")
+    server = bench.fakegithub.FakeGithub("owner", "repo", [], {})
+    server.start()
+    gh_options = dict(base_url=server.url, http_cache=None)
+
+    logging.info("A repo without pulls is synced.")
+    assert update_pulls(db_file, "token", "owner", "repo", **gh_options) == (0, 0)
+    pdb = grvdb.Pulls(db_file)
+    assert pdb.get_sync("owner", "repo") == grvtypes.PullSync(
+        "owner", "repo", None, None, None, None, None)
+
+    logging.info("No pulls keep the watermark of a repo.")
+    watermark = datetime.datetime(2015, 4, 17, 13, 7, 13)
+    pdb.save_sync(grvtypes.PullSync("owner", "repo", watermark, None, None, None, None))
+    assert update_pulls(db_file, "token", "owner", "repo", **gh_options) == (0, 0)
+    assert init_pulls(db_file, "token", "owner", "repo", **gh_options) == (0, 0)
+    assert pdb.get_sync("owner", "repo") == grvtypes.PullSync(
+        "owner", "repo", watermark, None, None, None, None)
 
+    # Closes the kept-alive client connections (PyGithub's close() leaves
+    # its requests session open), so the threads serving them end before
+    # the interpreter does.
+    for cnx in grvgithub._Connection.local.__dict__.get("connections", {}).values():
+        getattr(cnx, "session", cnx).close()
+    time.sleep(0.1)
+    server.shutdown()
+    server.server_close()
+    shutil.rmtree(tmp)